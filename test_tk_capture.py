@@ -0,0 +1,528 @@
+import io
+import os
+import queue
+import random
+import socket
+import threading
+import time
+
+import pytest
+from PIL import Image, ImageDraw
+
+import tk_capture
+from tk_capture import Style, save_image
+
+
+def ui_image(count, size=(320, 200)):
+    """
+    界面风格的测试图: count种颜色的色块，包含只差1的相近颜色
+    """
+    rnd = random.Random(count)
+    colors = [(101, 100, 100), (100, 100, 100), (255, 255, 255), (254, 255, 255)]
+    colors += [tuple(rnd.randrange(256) for _ in range(3)) for _ in range(count - len(colors))]
+    image = Image.new('RGB', size)
+    image.putdata([colors[(x // 7 + y // 5 * 13) % count] for y in range(size[1]) for x in range(size[0])])
+    return image
+
+
+@pytest.mark.parametrize('count', [4, 16, 187, 256])
+@pytest.mark.parametrize('parallel', [False, True])
+def test_save_image_palette_is_lossless(tmp_path, monkeypatch, count, parallel):
+    monkeypatch.setattr(Style, 'png_parallel_pixels', 1 if parallel else 0)
+    image = ui_image(count)
+    assert len(image.getcolors(256)) == count
+    file_name = save_image(image, str(tmp_path / 'shot.png'))
+    with Image.open(file_name) as saved:
+        assert saved.mode == 'P'
+        assert saved.convert('RGB').tobytes() == image.tobytes()
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_save_image_rgb_is_lossless(tmp_path, monkeypatch, parallel):
+    monkeypatch.setattr(Style, 'png_parallel_pixels', 1 if parallel else 0)
+    image = Image.new('RGB', (300, 211))
+    image.putdata([(x % 256, y % 256, (x * y) % 256) for y in range(211) for x in range(300)])
+    assert image.getcolors(256) is None
+    file_name = save_image(image, str(tmp_path / 'shot.png'))
+    with Image.open(file_name) as saved:
+        assert saved.convert('RGB').tobytes() == image.tobytes()
+
+
+def test_exact_palette_rejects_lossy_conversion(monkeypatch):
+    image = ui_image(16)
+    monkeypatch.setattr(Image.Image, 'quantize', lambda self, *args, **kwargs: self.convert('L').convert('P'))
+    assert tk_capture.exact_palette(image, 16) is None
+
+
+def detect(image):
+    detector = tk_capture.RegionDetector(image)
+    for _ in range(500):
+        if detector.ready:
+            return detector
+        time.sleep(0.01)
+    raise TimeoutError('region detection did not finish')
+
+
+@pytest.mark.parametrize('box', [(96, 96, 896, 704), (100, 100, 900, 700), (103, 77, 911, 689)])
+def test_region_at_finds_window(box):
+    image = Image.new('RGB', (1920, 1080), (236, 236, 236))
+    ImageDraw.Draw(image).rectangle(box, fill=(250, 250, 250), outline=(60, 60, 60), width=2)
+    detector = detect(image)
+    # 区域为窗口外边框，右下为开区间
+    assert detector.region_at(500, 400) == (box[0], box[1], box[2] + 1, box[3] + 1)
+    assert detector.region_at(50, 50) is None
+
+
+def test_region_at_finds_each_window():
+    image = Image.new('RGB', (1280, 800), (30, 30, 30))
+    draw = ImageDraw.Draw(image)
+    boxes = [(40, 40, 600, 420), (660, 60, 1200, 380), (200, 480, 1100, 760)]
+    for box in boxes:
+        draw.rectangle(box, fill=(245, 245, 245), outline=(90, 90, 90))
+        draw.text((box[0] + 20, box[1] + 20), 'some window text', fill=(0, 0, 0))
+    detector = detect(image)
+    for x1, y1, x2, y2 in boxes:
+        assert detector.region_at((x1 + x2) // 2, (y1 + y2) // 2) == (x1, y1, x2 + 1, y2 + 1)
+
+
+def test_region_at_synthetic_screen():
+    detector = detect(tk_capture.synthetic_screen(1920, 1080))
+    for x, y in ((160, 120), (480, 295)):
+        region = detector.region_at(x, y)
+        assert region is not None
+        window = (x // 320 * 320 + 10, y // 240 * 240 + 10, x // 320 * 320 + 301, y // 240 * 240 + 221)
+        assert window[0] <= region[0] < x < region[2] <= window[2]
+        assert window[1] <= region[1] < y < region[3] <= window[3]
+
+
+@pytest.mark.parametrize('ext', ['gif', 'webp', 'png'])
+def test_export_keeps_variable_frame_timing(tmp_path, monkeypatch, ext):
+    monkeypatch.setattr(Style, 'export_formats', [])
+    recorder = tk_capture.GifRecorder(None)
+    recorder.mode = 'Adaptive'
+    store = tk_capture.FrameStore(1)
+    # 录制中帧率从10fps降到4fps
+    stamps = [0, 0.1, 0.2, 0.3, 0.55, 0.8, 1.05]
+    for n, stamp in enumerate(stamps):
+        store.append(Image.new('RGB', (40, 30), (n * 30, 0, 0)), 100 + stamp)
+    store.finish()
+    indexes = recorder.frame_indexes(store)
+    durations = recorder.frame_durations(store, indexes)
+    assert [durations[i] for i in indexes] == [100, 100, 100, 250, 250, 250, 175]
+    file_name = str(tmp_path / f'clip.{ext}')
+    recorder.export(file_name, store, indexes, [durations[i] for i in indexes])
+    store.close()
+    with Image.open(file_name) as image:
+        saved = []
+        for frame in range(image.n_frames):
+            image.seek(frame)
+            image.load()
+            saved.append(image.info['duration'])
+    assert saved == [100, 100, 100, 250, 250, 250, 170 if ext == 'gif' else 175]
+
+
+@pytest.mark.parametrize('level', [0, 1])
+def test_frame_store_round_trip(level):
+    store = tk_capture.FrameStore(level)
+    images = [ui_image(16 + n, (64, 48)) for n in range(3)]
+    for n, image in enumerate(images):
+        store.append(image, n)
+    assert store.read(1).convert('RGB').tobytes() == images[1].tobytes()     # 录制中从文件读取
+    store.append(ui_image(8, (32, 24)), 3)
+    store.finish()
+    for image, n in zip(images, range(3)):
+        assert store.read(n).convert('RGB').tobytes() == image.tobytes()
+    # 不压缩时按第一帧尺寸定长存储，压缩时保留各帧尺寸
+    assert store.read(3).size == ((64, 48) if level == 0 else (32, 24))
+    assert store.times == [0, 1, 2, 3]
+    if level == 0:
+        assert store.position == 4 * 64 * 48 * 4 and store.read(0).readonly
+    store.close()
+    assert not os.path.exists(store.path)
+
+
+@pytest.mark.parametrize('mode, compress, level', [('High Quality', False, 0), ('High Quality', True, 1),
+                                                   ('Timelapse', False, 1), ('Adaptive', False, 3)])
+def test_create_store_level(monkeypatch, mode, compress, level):
+    monkeypatch.setattr(Style, 'record_compress', compress)
+    recorder = tk_capture.GifRecorder(None)
+    recorder.mode = mode
+    store = recorder.create_store()
+    assert store.level == level
+    store.close()
+
+def test_frame_indexes_sample_by_time():
+    recorder = tk_capture.GifRecorder(None)
+    recorder.mode = 'Adaptive'
+    recorder.export_fps = 5
+    store = tk_capture.FrameStore(1)
+    for stamp in [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.75, 1.0, 1.25]:
+        store.append(Image.new('RGB', (4, 4)), stamp)
+    assert recorder.frame_indexes(store) == [0, 2, 4, 6, 7, 8]
+    store.close()
+
+
+def test_serve_commands_rejects_oversized_payload(monkeypatch):
+    monkeypatch.setattr(Style, 'command_max_bytes', 1024)
+    server = socket.create_server(('127.0.0.1', 0))
+    port = server.getsockname()[1]
+    calls = []
+    tk_capture.create_thread(tk_capture.serve_commands, (server, {'echo': lambda h, p: calls.append(p) or len(p)}))
+    try:
+        assert tk_capture.send_command('echo', b'x' * 100, port=port) == 100
+        with socket.create_connection(('127.0.0.1', port), timeout=2) as sock:
+            sock.sendall(b'{"cmd": "echo", "length": 1099511627776}\n')
+            assert sock.makefile('rb').readline() == b''
+        assert tk_capture.send_command('echo', b'x' * 2048, port=port) is None
+        assert calls == [b'x' * 100]
+    finally:
+        server.close()
+
+
+def test_serve_commands_survives_bad_header_and_handler_error(caplog):
+    server = socket.create_server(('127.0.0.1', 0))
+    port = server.getsockname()[1]
+
+    def fail(header, payload):
+        raise RuntimeError('boom')
+
+    commands = {'echo': lambda h, p: len(p), 'fail': fail}
+    tk_capture.create_thread(tk_capture.serve_commands, (server, commands))
+    try:
+        with caplog.at_level('INFO', logger='tk_capture'):
+            with socket.create_connection(('127.0.0.1', port), timeout=2) as sock:
+                sock.sendall(b'[]\n')
+                assert sock.makefile('rb').readline() == b''
+            assert tk_capture.send_command('fail', b'x', port=port) is None
+            assert tk_capture.send_command('echo', b'xyz', port=port) == 3
+        assert any(r.levelname == 'ERROR' and r.exc_info for r in caplog.records)
+    finally:
+        server.close()
+
+
+def test_encode_failure_logs_traceback_and_drains_frames(monkeypatch, caplog):
+    def broken(file_name, images, durations, **kwargs):
+        next(images)
+        raise OSError('disk full')
+
+    monkeypatch.setattr(tk_capture, 'save_animation', broken)
+    recorder = tk_capture.GifRecorder(None)
+    frames = tk_capture.queue.Queue()
+    for n in range(3):
+        frames.put(Image.new('RGB', (8, 8), (n, 0, 0)))
+    frames.put(None)
+    with caplog.at_level('INFO', logger='tk_capture'):
+        recorder.encode((0, 'webp'), 'clip.webp', frames, 3, [100] * 3)
+    assert frames.empty() and recorder.export_progress[(0, 'webp')] == 100
+    assert any(r.levelname == 'ERROR' and 'clip.webp' in r.getMessage() and r.exc_info for r in caplog.records)
+
+
+@pytest.mark.parametrize('moving', [False, True])
+def test_estimate_size_close_to_export(tmp_path, monkeypatch, moving):
+    monkeypatch.setattr(Style, 'export_formats', [])
+    recorder = tk_capture.GifRecorder(None)
+    recorder.mode = 'Adaptive'
+    store = recorder.store = tk_capture.FrameStore(1)
+    screen = tk_capture.synthetic_screen(640, 480)
+    for n in range(60):
+        image = screen.copy()
+        if moving:
+            ImageDraw.Draw(image).rectangle((n * 8, 100, n * 8 + 60, 160), fill=(200, 30, 30))
+        store.append(image, n * 0.1)
+    store.finish()
+    estimate = recorder.estimate_size()
+    indexes = recorder.frame_indexes(store)
+    durations = recorder.frame_durations(store, indexes)
+    recorder.export(str(tmp_path / 'clip.gif'), store, indexes, [durations[i] for i in indexes])
+    size = os.path.getsize(tmp_path / 'clip.gif')
+    store.close()
+    assert abs(estimate - size) <= size * 0.2
+
+
+def test_render_marks_keeps_alpha():
+    image = Image.new('RGBA', (120, 80), (10, 20, 30, 0))
+    image.paste((200, 200, 200, 128), (60, 0, 120, 80))
+    marks = [{'type': 'rectangle', 'box': [10, 10, 50, 50], 'color': 0, 'width': 0},
+             {'type': 'pixelate', 'box': [60, 0, 120, 80]}]
+    result = tk_capture.render_marks(image, marks)
+    assert result.mode == 'RGBA'
+    assert result.getpixel((5, 5)) == (10, 20, 30, 0)
+    assert result.getpixel((10, 30))[3] == 255
+    *rgb, alpha = result.getpixel((90, 40))   # 缩放按预乘透明度计算，颜色允许1的误差
+    assert alpha == 128 and all(abs(c - 200) <= 1 for c in rgb)
+
+
+def test_batch_render_logs_failures(tmp_path, caplog):
+    marks_file = tmp_path / 'marks.json'
+    marks_file.write_text('[{"type": "oval", "box": [2, 2, 30, 30]}]')
+    good = tmp_path / 'good.png'
+    Image.new('RGBA', (40, 40), (0, 0, 0, 0)).save(good)
+    bad = tmp_path / 'bad.png'
+    bad.write_bytes(b'not an image')
+    with caplog.at_level('INFO', logger='tk_capture'):
+        tk_capture.batch_render(str(marks_file), [str(good), str(bad)], str(tmp_path / 'out'), jobs=1)
+    with Image.open(tmp_path / 'out' / 'good.png') as output:
+        assert output.mode == 'RGBA'
+    assert any(r.levelname == 'ERROR' and 'bad.png' in r.getMessage() and r.exc_info for r in caplog.records)
+    assert any('1/2 images annotated' in r.getMessage() for r in caplog.records)
+
+
+def test_render_marks_requires_box():
+    image = Image.new('RGB', (40, 40))
+    marks = [{'type': 'rectangle', 'box': [2, 2, 20, 20]}, {'type': 'pixelate'}]
+    with pytest.raises(ValueError, match='pixelate'):
+        tk_capture.render_marks(image, marks)
+    with pytest.raises(ValueError, match='bad box'):
+        tk_capture.render_marks(image, [{'type': 'line', 'box': [1, 2]}])
+
+
+def test_batch_render_skips_bad_marks(tmp_path, caplog):
+    marks_file = tmp_path / 'marks.json'
+    marks_file.write_text('[{"type": "oval"}, {"type": "rectangle", "box": [2, 2, 30, 30], "color": 0}]')
+    image = tmp_path / 'shot.png'
+    Image.new('RGB', (40, 40)).save(image)
+    with caplog.at_level('INFO', logger='tk_capture'):
+        tk_capture.batch_render(str(marks_file), [str(image)], str(tmp_path / 'out'), jobs=1)
+    assert any(r.levelname == 'ERROR' and 'oval' in r.getMessage() for r in caplog.records)
+    assert any('1/1 images annotated' in r.getMessage() for r in caplog.records)
+    with Image.open(tmp_path / 'out' / 'shot.png') as output:
+        assert output.getpixel((2, 16)) == Style.text_rgb[Style.text_colors[0]]
+
+
+def test_start_waits_for_estimate_without_dropping_flags(monkeypatch):
+    monkeypatch.setattr(Style, 'edit_switch', False)
+    recorder = tk_capture.GifRecorder(None)
+    recorder.mode = 'High Quality'
+    store = tk_capture.FrameStore(1)
+    for n in range(4):
+        store.append(Image.new('RGB', (16, 16), (n, 0, 0)), n * 0.2)
+    store.finish()
+    started, release, states = threading.Event(), threading.Event(), []
+
+    def record(store=None):
+        recorder.store = store_ref
+        tk_capture.create_thread(recorder.estimate_size)
+        started.wait(2)
+        return store_ref, len(store_ref)
+
+    def slow_estimate(*args):
+        started.set()
+        release.wait(2)
+        states.append(store_ref.file.closed)
+        return 0
+
+    store_ref = store
+    monkeypatch.setattr(recorder, 'create_store', lambda: store)
+    monkeypatch.setattr(recorder, 'record', record)
+    monkeypatch.setattr(recorder, 'estimate_store', slow_estimate)
+    monkeypatch.setattr(tk_capture.filedialog, 'asksaveasfilename', lambda **kwargs: '')
+    thread = tk_capture.create_thread(recorder.start)
+    for _ in range(50):
+        time.sleep(0.01)
+        assert recorder.is_recording or recorder.is_asking or recorder.is_saving
+    release.set()
+    thread.join(2)
+    assert states == [False]
+    assert store.file.closed and not recorder.is_saving
+
+
+def gif_size(frames, budget, monkeypatch):
+    monkeypatch.setattr(Style, 'gif_lossy', budget)
+    recorder = tk_capture.GifRecorder(None)
+    lossy = recorder.lossy_filter()
+    buffer = io.BytesIO()
+    tk_capture.save_animation(buffer, [recorder.quantize_image(frame, lossy) for frame in frames], 100, format='gif')
+    return buffer.tell()
+
+
+def test_gif_lossy_shrinks_noisy_frames(monkeypatch):
+    screen = tk_capture.synthetic_screen(480, 320)
+    clean, noisy = [], []
+    for n in range(12):
+        image = screen.copy()
+        ImageDraw.Draw(image).rectangle((n * 30, 100, n * 30 + 60, 160), fill=(200, 30, 30))
+        clean.append(image)
+        noisy.append(Image.blend(image, Image.effect_noise(image.size, 12).convert('RGB'), 0.08))
+    assert gif_size(noisy, 16, monkeypatch) < gif_size(noisy, 0, monkeypatch) * 0.5
+    assert gif_size(clean, 16, monkeypatch) <= gif_size(clean, 0, monkeypatch)
+    # 共用调色板，静止的像素逐帧输出完全相同
+    lossy = tk_capture.LossyFilter(16)
+    first = lossy.quantize(noisy[0], 256).convert('RGB')
+    second = lossy.quantize(noisy[1], 256).convert('RGB')
+    assert first.crop((0, 0, 480, 90)).tobytes() == second.crop((0, 0, 480, 90)).tobytes()
+
+
+def test_replay_buffer_reconstructs_and_dumps(tmp_path, monkeypatch):
+    monkeypatch.setattr(Style, 'replay_fps', 1000)
+    monkeypatch.setattr(Style, 'replay_keyframe', 3)
+    images = [Image.new('RGB', (32, 24), (n * 40, 255 - n * 40, 7)) for n in range(6)]
+    images.insert(2, images[1].copy())     # 画面不变的差值帧不存数据
+    replay = tk_capture.ReplayBuffer((0, 0, 32, 24))
+    grabbed = iter(images)
+
+    def grab():
+        image = next(grabbed)
+        replay.stop_flag = image is images[-1]
+        return image
+
+    monkeypatch.setattr(replay, 'grab', grab)
+    replay.run()
+    assert [len(group) for group in replay.groups] == [3, 3, 1]
+    assert replay.groups[0][2][2] == b''
+    assert [image.tobytes() for _, image in replay.frames(60)] == [image.tobytes() for image in images]
+    result = replay.dump_command({'seconds': '60', 'file': str(tmp_path / 'replay.gif')}, b'')
+    with Image.open(result['file']) as saved:
+        assert saved.n_frames == len(images) - 1     # GIF把相同的相邻帧合并
+    for seconds in ('abc', None, [1], 0, float('nan')):
+        with pytest.raises(ValueError):
+            replay.dump_command({'seconds': seconds}, b'')
+
+
+def test_adaptive_controller_adjusts(monkeypatch):
+    monkeypatch.setattr(Style, 'adaptive_size', 1)
+    recorder = tk_capture.GifRecorder(None)
+    recorder.mode = 'Adaptive'
+    store = tk_capture.FrameStore(3)
+    frames = queue.Queue()
+    for _ in range(10):
+        frames.put(None)
+    controller = tk_capture.AdaptiveController(recorder, store, frames)
+    # 写入队列积压时先降低压缩级别
+    controller.window_start -= 1.5
+    controller.update()
+    assert store.level == 2 and recorder.capture_scale == 1 and controller.fps == 15
+    # 预估超出文件大小目标时降低帧率
+    while not frames.empty():
+        frames.get()
+    controller.projected = 2 * 1024 * 1024
+    controller.window_start -= 1.5
+    controller.update()
+    assert controller.fps == 12 and controller.projected is None
+    store.close()
+
+
+def test_adaptive_estimate_projects_short_lookahead(monkeypatch):
+    recorder = tk_capture.GifRecorder(None)
+    recorder.mode = 'Adaptive'
+    monkeypatch.setattr(recorder, 'estimate_size', lambda: 1000)
+    controller = tk_capture.AdaptiveController(recorder, tk_capture.FrameStore(1), queue.Queue())
+    controller.estimating = True
+    controller.estimate(10)
+    assert controller.projected == 1000 * (10 + controller.lookahead) / 10 and not controller.estimating
+    controller.estimate(290)    # 不超过时长限制
+    assert controller.projected == 1000 * 300 / 290
+    controller.store.close()
+
+
+def test_record_timelapse_keeps_changed_frames(monkeypatch):
+    monkeypatch.setattr(Style, 'timelapse_interval', 0)
+    recorder = tk_capture.GifRecorder(None)
+    recorder.mode = 'Timelapse'
+    black, white = Image.new('RGB', (32, 32)), Image.new('RGB', (32, 32), (255, 255, 255))
+    half = white.copy()
+    half.paste(black, (16, 0))
+    shots = iter([black, black, half, half, half, black, black])
+
+    def grab():
+        image = next(shots, None)
+        if image is None:
+            recorder.stop_flag = True
+            return black
+        return image
+
+    monkeypatch.setattr(recorder, 'grab', grab)
+    store, count = recorder.record_timelapse()
+    assert count == 3
+    assert [store.read(i).tobytes() for i in range(count)] == [black.tobytes(), half.tobytes(), black.tobytes()]
+    indexes = recorder.frame_indexes(store)
+    assert indexes == [0, 1, 2]
+    assert recorder.frame_durations(store, indexes) == {0: 200, 1: 200, 2: 200}
+    store.close()
+
+
+def test_screen_history_dedup(tmp_path, monkeypatch):
+    monkeypatch.setattr(Style, 'save_webp', False)
+    history = tk_capture.ScreenHistory(str(tmp_path))
+    first, second = ui_image(4, (40, 30)), ui_image(16, (40, 30))
+    path = history.add(first, (0, 0, 40, 30))
+    assert history.add(second, (10, 10, 50, 40)) != path
+    assert history.add(first.copy(), (5, 5, 45, 35)) == path
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.png')]) == 2
+    # 重新加载后同一哈希以最后一行为准，最近截图的排在最前
+    reloaded = tk_capture.ScreenHistory(str(tmp_path))
+    records, total = reloaded.latest()
+    assert total == 2 and reloaded.index_lines == 3
+    assert [reloaded.file(record) for record in records][0] == path
+    assert records[0]['region'] == [0, 0, 40, 30]
+
+
+def test_screen_history_caps_thumbnails(tmp_path, monkeypatch):
+    monkeypatch.setattr(Style, 'save_webp', False)
+    monkeypatch.setattr(tk_capture.ScreenHistory, 'thumb_limit', 5)
+    history = tk_capture.ScreenHistory(str(tmp_path), cache_size=2)
+    for n in range(8):
+        history.add(ui_image(4 + n, (40, 30)), (0, 0, 40, 30))
+    records, _ = history.latest()
+    for record in records[:5]:
+        history.thumbnail(record)
+    os.remove(history.file(records[4]))     # 原图被删除的缩略图比更旧的缩略图先清理
+    for record in records[5:]:
+        history.thumbnail(record)
+    thumbs = os.listdir(tmp_path / '.thumbs')
+    assert len(thumbs) <= 5 and history.thumb_count == len(thumbs)
+    assert records[4]['hash'] + '.png' not in thumbs and records[3]['hash'] + '.png' in thumbs
+
+
+@pytest.mark.parametrize('scale', [1, 2, 4])
+def test_draw_cursor_scales_with_capture(scale):
+    full = Image.new('RGB', (160, 120), (255, 255, 255))
+    tk_capture.draw_cursor(full, 80, 40)
+    image = Image.new('RGB', (160 // scale, 120 // scale), (255, 255, 255))
+    tk_capture.draw_cursor(image, 80, 40, scale)
+    # 缩小后的指针与原始尺寸的指针缩小后位置、大小一致
+    x1, y1, x2, y2 = full.convert('L').point(lambda v: v < 250 and 255).getbbox()
+    box = image.convert('L').point(lambda v: v < 250 and 255).getbbox()
+    assert box[:2] == (x1 // scale, y1 // scale)
+    assert all(abs(a - b / scale) <= 1 for a, b in zip(box[2:], (x2, y2)))
+
+
+def rows(image):
+    return tk_capture.LongCapture.row_hashes(image.tobytes(), image.width * 3)
+
+
+def test_long_capture_find_overlap():
+    page = ui_image(187, (60, 400))
+    prev, cur = page.crop((0, 0, 60, 150)), page.crop((0, 100, 60, 250))
+    find_overlap = tk_capture.LongCapture.find_overlap
+    assert find_overlap(rows(prev), rows(cur)) == 50
+    assert find_overlap(rows(prev), rows(prev)) == 150
+    assert find_overlap(rows(prev), rows(page.crop((0, 145, 60, 295)))) == 0     # 重叠少于min_rows
+    assert find_overlap(rows(prev), rows(page.crop((0, 200, 60, 350)))) == 0
+
+
+def test_write_png_streams_blocks(tmp_path):
+    image = ui_image(187, (70, 53))
+    data = image.tobytes()
+    stride = image.width * 3
+    blocks = [data[i: i + stride * 10] for i in range(0, len(data), stride * 10)]
+    tk_capture.write_png(str(tmp_path / 'long.png'), image.width, image.height, iter(blocks))
+    with Image.open(tmp_path / 'long.png') as saved:
+        assert saved.mode == 'RGB' and saved.tobytes() == data
+
+
+def test_mark_index_lookups():
+    index = tk_capture.MarkIndex()
+    index.add(1, (10, 10, 100, 100))
+    index.add(2, (50, 50, 300, 60))     # 跨越多个网格
+    index.add(3, (200, 200, 210, 210))
+    assert index.query(55, 55) == [2, 1]
+    assert index.query(250, 55) == [2]
+    assert index.query(150, 150) == []
+    assert index.query(212, 205) == [] and index.query(212, 205, pad=4) == [3]
+    index.move(2, (400, 400, 420, 420))
+    assert index.query(250, 55) == [] and index.query(410, 410) == [2]
+    index.remove(1)
+    index.remove(1)
+    assert index.query(55, 55) == []
+    # 空网格被移除，索引大小只与现有标记有关
+    assert set(index.cells) == set(index.cells_of((200, 200, 210, 210))) | set(index.cells_of((400, 400, 420, 420)))
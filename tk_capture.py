@@ -15,15 +15,37 @@
 """
 A lightweight screenshot and screen recording tool developed based on python tkinter.
 """
+import io
 import os
+import re
+import math
+import mmap
 import time
+import zlib
+import queue
 import json
+import socket
+import logging
+import bisect
+import struct
 import shutil
+import hashlib
+import argparse
+import itertools
+import tempfile
 import threading
-import pyautogui
+import subprocess
 import tkinter as tk
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tkinter import ttk, filedialog, messagebox
-from PIL import Image, ImageGrab, ImageTk, ImageDraw
+from PIL import Image, ImageGrab, ImageTk, ImageDraw, ImageChops, ImageFont, ImageFilter
+try:
+    import pyautogui
+except Exception:   # 无图形界面时（如批量标注）无法导入，只有截屏录屏需要
+    pyautogui = None
+
+logger = logging.getLogger('tk_capture')
 
 
 class Style:
@@ -33,15 +55,21 @@ class Style:
     version = '2.0.1'
     font = '黑体'   # 'Sans Serif'
     tool_bg = 'Snow'
-    shot_types = ('PNG', 'GIF')
+    shot_types = ('PNG', 'GIF', 'LONG')
     settings_file = 'settings.json'
     theme_color = 'Lime'            # 默认主题色
     lines_color = 'Red'             # 截屏X Y辅助线颜色
     theme_colors = ['Lime', 'Cyan', 'Orange', 'HotPink']
     text_colors = ['Red', 'Yellow', 'Green', 'Blue', 'Black', 'Grey', 'Snow']
+    text_rgb = {                    # 标记颜色在tk中的RGB值，批量标注使用
+        'Red': (255, 0, 0), 'Yellow': (255, 255, 0), 'Green': (0, 255, 0), 'Blue': (0, 0, 255),
+        'Black': (0, 0, 0), 'Grey': (190, 190, 190), 'Snow': (255, 250, 250)
+    }
+    text_fonts = ('simhei.ttf', 'msyh.ttc', 'DejaVuSans.ttf', 'arial.ttf')    # 批量标注文字的候选字体
     rectangle_style = {}            # 截图矩形选框样式
     rectangle_limit = 30            # 矩形选框的X Y最小像素
     dot_offset = 7                  # 矩形选框调整圆点的半径
+    adjust_interval = 16            # 调整选框时合并拖动事件的间隔（毫秒），约为显示帧率
     default_cursor = 'arrow'        # 默认鼠标样式
     rect_cursor = 'crosshair'       # 选框开始时鼠标样式
     hand_cursor = 'hand2'           # 按钮提示鼠标样式
@@ -57,19 +85,63 @@ class Style:
         'fleur'                     # 选框移动鼠标样式
     ]
     tool_window_size = {            # 工具栏的宽高
-        "pic": (640, 70),
-        "gif": (370, 40)
+        "pic": (720, 70),
+        "gif": (460, 70),
+        "long": (320, 40)
     }
     text_pt_values = ('10pt', '14pt', '18pt', '24pt', '36pt', '48pt', '60pt', '72pt', '96pt')
     mark_pi_values = ('1pi', '2pi', '4pi', '6pi', '8pi', '10pi', '12pi', '14pi')
+    scale_values = ('100%', '75%', '50%', '25%')            # 录屏导出的缩放比例
+    fps_values = ('Auto', '15fps', '10fps', '5fps')         # 录屏导出的帧率，Auto为录制帧率
+    color_values = ('256c', '128c', '64c', '32c', '16c')    # 录屏导出GIF的颜色数
+    grab_values = ('1:1', '1:2', '1:3', '1:4')             # 录屏抓屏后立即缩小的比例
     choose_color = text_colors[0]   # 工具栏选择的颜色
     choose_pt = text_pt_values[2]   # 工具栏选择的字号
     choose_pi = mark_pi_values[2]   # 工具栏选择的线框粗细（像素）
     mask_switch = True
     tips_switch = True
+    loupe_switch = True
+    snap_switch = True              # 选框吸附界面边缘，鼠标悬停时高亮检测到的区域
+    edit_switch = True              # 录屏结束后导出前打开帧编辑器
+    loupe_radius = 10               # 放大镜显示鼠标周围的像素半径
+    loupe_zoom = 6                  # 放大镜的放大倍数
     tip = f'TkCapture v{version}\n\n%s'
     choose_lang = 'EN'
     languages = ('EN', 'CN')
+    timelapse_interval = 2          # 延时录制的采样间隔（秒）
+    timelapse_threshold = 6         # 延时录制保留新帧的哈希差异位数阈值
+    timelapse_hash_size = 16        # 延时录制感知哈希的边长，哈希共 size*size 位
+    long_scroll_clicks = 3          # 长截图自动滚动时每次滚动的格数
+    long_interval = 0.3             # 长截图两次截取的间隔（秒）
+    record_compress = False         # 录屏帧存储是否使用zlib快速压缩，默认按原始像素定长存储，导出时零拷贝读取
+    adaptive_cpu = 0                # 自适应录制的CPU预算（单核占用比例，如0.5），0为不限制
+    adaptive_size = 0               # 自适应录制的导出文件大小目标（MB），0为不限制
+    last_region = None              # 上一次截图的区域（虚拟桌面坐标），--last直接截取
+    saved_regions = {}              # 命名保存的截图区域，--region NAME直接截取
+    export_formats = []             # 录屏导出时除所选文件外同时导出的格式: gif webp apng mp4 webm
+    export_options = {              # 各导出格式的编码参数，视频格式为ffmpeg的编码参数
+        'gif': {},
+        'webp': {'quality': 80, 'method': 4},
+        'apng': {},
+        'mp4': ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23'],
+        'webm': ['-c:v', 'libvpx-vp9', '-b:v', '0', '-crf', '34', '-deadline', 'realtime']
+    }
+    save_webp = False               # 超过256色的截图（照片、渐变）保存为无损WebP
+    png_level = 3                   # 超过256色的截图保存PNG的zlib压缩级别
+    png_parallel_pixels = 8000000   # 像素数不小于该值的截图分条带多线程压缩PNG，0为关闭
+    gif_lossy = 0                   # GIF有损压缩的单像素误差上限（0-255），0为无损
+    select_tolerance = 4            # 选择标记时鼠标距线条的容差（像素）
+    tile_size = 256                 # 冻结截图分块显示的块边长，鼠标所在的块最先显示
+    pin_port = 47651                # 贴图进程监听的本地端口，后续截图的贴图交给该进程显示
+    pin_zoom_values = (0.25, 0.33, 0.5, 0.75, 1, 1.25, 1.5, 2, 3, 4)    # 贴图滚轮缩放的级别
+    pin_cache_levels = 4            # 每张贴图缓存的缩放级别数量
+    replay_port = 47652             # 回放缓冲进程监听的本地端口
+    command_max_bytes = 512 * 1024 * 1024   # 本地命令payload的长度上限，超过的命令直接拒绝
+    replay_fps = 5                  # 回放缓冲的目标帧率
+    replay_seconds = 60             # 回放缓冲最多保留的秒数
+    replay_memory = 64              # 回放缓冲的内存上限（MB）
+    replay_keyframe = 25            # 每隔多少帧保存一个完整的关键帧，其余帧只保存与上一帧的差值
+    replay_cpu = 0.1                # 回放缓冲的CPU预算（单核占用比例），超出时自动降低帧率
 
     @classmethod
     def get_pt(cls):
@@ -91,9 +163,11 @@ class Style:
             'Pen': ('Pen', "画笔"),
             'Text': ("Text", "文本"),
             'Mosaic': ("Mosaic", "马赛克"),
+            'Select': ("Select / Move / Delete", "选择/移动/删除标记"),
             'Revoke': ("Revoke", "撤销"),
             'Exit': ("Exit", "退出"),
             'Hang': ("Hang", "悬浮"),
+            'History': ("History", "历史截图"),
             'To Clipboard': ("To Clipboard", "保存到剪切板"),
             'Theme': ("Theme", "主题色"),
             'Font Size': ('Font Size', "字体大小"),
@@ -103,8 +177,25 @@ class Style:
             'Turn On Prompt': ('Turn On Prompt', "开启提示语"),
             'Turn Off Prompt': ('Turn Off Prompt', "关闭提示语"),
             'Outer Mask': ('Outer Mask', "外部遮罩"),
+            'Loupe': ('Loupe', "放大镜"),
+            'Snap': ('Snap To Edges', "吸附边缘"),
+            'Auto Scroll': ('Auto Scroll', "自动滚动"),
+            'Manual Scroll': ('Manual Scroll', "手动滚动"),
             'Too small range': ('Too small range', "截图区域过小"),
-            'Language': ('Language', "语言")
+            'Region kept': ('Region kept for recording, select the next one', "已保留录屏区域，请框选下一个区域"),
+            'Language': ('Language', "语言"),
+            'Scale': ('Scale', "缩放"),
+            'Frame Rate': ('Frame Rate', "帧率"),
+            'Colors': ('Colors', "颜色数"),
+            'Capture Scale': ('Capture Scale', "录制缩小比例"),
+            'Estimated Size': ('Estimated GIF Size', "预估GIF大小"),
+            'Edit Frames': ('Edit Before Export', "导出前编辑"),
+            'Trim Start': ('Trim Before Cursor', "删除之前的帧"),
+            'Trim End': ('Trim After Cursor', "删除之后的帧"),
+            'Mark': ('Mark Range Start', "标记区间起点"),
+            'Delete Range': ('Delete Marked Range', "删除标记的区间"),
+            'Reset': ('Reset', "重置"),
+            'OK': ('OK', "确定")
         }.get(key, ('', ''))[cls.languages.index(cls.choose_lang)]
 
     @classmethod
@@ -116,10 +207,49 @@ class Style:
         cls.theme_color = data.get('theme_color', 'Lime')
         cls.mask_switch = data.get('mask_switch', True)
         cls.tips_switch = data.get('tips_switch', True)
+        cls.loupe_switch = data.get('loupe_switch', True)
+        cls.snap_switch = data.get('snap_switch', True)
+        cls.edit_switch = data.get('edit_switch', True)
         cls.choose_pt = data.get('default_pt', '16pt')
         cls.choose_pi = data.get('default_pi', '4pi')
         cls.rectangle_style = {'width': 2, 'outline': cls.theme_color}
         cls.choose_lang = data.get('language', 'EN')
+        cls.timelapse_interval = data.get('timelapse_interval', 2)
+        cls.timelapse_threshold = data.get('timelapse_threshold', 6)
+        cls.record_compress = data.get('record_compress', False)
+        cls.adaptive_cpu = data.get('adaptive_cpu', 0)
+        cls.adaptive_size = data.get('adaptive_size', 0)
+        cls.gif_lossy = data.get('gif_lossy', 0)
+        cls.save_webp = data.get('save_webp', False)
+        cls.export_formats = data.get('export_formats', [])
+        cls.last_region = data.get('last_region')
+        cls.saved_regions = data.get('saved_regions', {})
+        cls.export_options.update(data.get('export_options', {}))
+
+    @classmethod
+    def dump_settings(cls):
+        return {
+            'theme_color': cls.theme_color,
+            'mask_switch': cls.mask_switch,
+            'tips_switch': cls.tips_switch,
+            'loupe_switch': cls.loupe_switch,
+            'snap_switch': cls.snap_switch,
+            'edit_switch': cls.edit_switch,
+            'default_pt': cls.choose_pt,
+            'default_pi': cls.choose_pi,
+            'language': cls.choose_lang,
+            'timelapse_interval': cls.timelapse_interval,
+            'timelapse_threshold': cls.timelapse_threshold,
+            'record_compress': cls.record_compress,
+            'adaptive_cpu': cls.adaptive_cpu,
+            'adaptive_size': cls.adaptive_size,
+            'gif_lossy': cls.gif_lossy,
+            'save_webp': cls.save_webp,
+            'export_formats': cls.export_formats,
+            'last_region': cls.last_region,
+            'saved_regions': cls.saved_regions,
+            'export_options': cls.export_options
+        }
 
     @classmethod
     def write_settings(cls, data):
@@ -131,6 +261,531 @@ def create_thread(func, args=()):
     th = threading.Thread(target=func, args=args)
     th.daemon = True
     th.start()
+    return th
+
+
+def image_hash(image, size=8):
+    """
+    计算图片的差异哈希(dHash)：缩小为(size+1)*size的灰度图，逐行比较相邻像素明暗
+    return: size*size位的整数
+    """
+    pixels = image.resize((size + 1, size), Image.BOX).convert('L').tobytes()
+    value = 0
+    for row in range(size):
+        for col in range(row * (size + 1), row * (size + 1) + size):
+            value = value << 1 | (pixels[col] > pixels[col + 1])
+    return value
+
+
+def image_digest(image):
+    """
+    按尺寸和像素内容计算图片的摘要，内容相同的图片摘要相同
+    """
+    return hashlib.sha1(b'%dx%d' % image.size + image.tobytes()).hexdigest()[:20]
+
+
+def hash_distance(hash1, hash2):
+    """
+    两个哈希值的汉明距离
+    """
+    return bin(hash1 ^ hash2).count('1')
+
+
+def draw_cursor(image, x, y, scale=1):
+    """
+    在录制的帧上画鼠标指针
+    x, y: 指针尖端相对录制区域左上角的屏幕坐标
+    scale: 帧相对屏幕缩小的倍数，指针的位置和大小同样缩小
+    """
+    x, y = x / scale, y / scale
+    ImageDraw.Draw(image).polygon((x, y, x, y + 18 / scale, x + 13 / scale, y + 13 / scale),
+                                  fill=(0, 0, 0), outline=(200, 200, 200), width=max(1, round(2 / scale)))
+
+
+def segment_distance(x, y, x1, y1, x2, y2):
+    """
+    点(x, y)到线段(x1, y1)-(x2, y2)的距离
+    """
+    dx, dy = x2 - x1, y2 - y1
+    t = ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy) if dx or dy else 0
+    t = min(max(t, 0), 1)
+    return math.hypot(x - x1 - t * dx, y - y1 - t * dy)
+
+
+def format_size(size):
+    """
+    字节数转换为可读的大小
+    """
+    for unit in ('B', 'K', 'M'):
+        if size < 1024:
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}G'
+
+
+def save_animation(file_name, images, duration, format=None, **options):
+    """
+    保存动图，根据文件后缀选择WebP或GIF格式
+    images: 帧图片的迭代器
+    duration: 每帧时长（毫秒），或每帧时长的列表
+    format: 指定格式，保存到内存文件时使用
+    options: 编码参数，覆盖默认值
+    """
+    images = iter(images)
+    first = next(images)
+    format = format or ('webp' if file_name.lower().endswith('.webp') else 'gif')
+    if format == 'webp':
+        rgb_image(first).save(
+            file_name, format='webp', save_all=True, append_images=(rgb_image(image) for image in images),
+            duration=duration, loop=0, **dict({'quality': 80, 'method': 4}, **options))
+    else:
+        first = first if first.mode == 'P' else rgb_image(first).convert('P')
+        first.save(
+            file_name, format='gif', save_all=True, duration=duration, loop=0,
+            append_images=(image if image.mode == 'P' else rgb_image(image).convert('P') for image in images),
+            **dict({'optimize': True}, **options))
+
+
+def png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+
+def adler32_combine(adler1, adler2, length2):
+    """
+    由两段数据各自的adler32和第二段的长度算出拼接后的adler32，同zlib的adler32_combine
+    """
+    base = 65521
+    rem = length2 % base
+    sum1 = ((adler1 & 0xffff) + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (rem * (adler1 & 0xffff) + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    return sum1 | (sum2 << 16)
+
+
+def write_png(file_name, width, height, blocks, level=6):
+    """
+    流式写入RGB格式的PNG，内存占用与图片高度无关
+    blocks: 逐块产出的原始像素数据，每块包含若干完整的行
+    """
+    chunk = png_chunk
+    stride = width * 3
+    compressor = zlib.compressobj(level)
+    with open(file_name, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        for block in blocks:
+            view = memoryview(block)
+            # 每行前加过滤类型0(None)
+            data = compressor.compress(b''.join(b'\x00' + view[i: i + stride] for i in range(0, len(view), stride)))
+            if data:
+                f.write(chunk(b'IDAT', data))
+        f.write(chunk(b'IDAT', compressor.flush()))
+        f.write(chunk(b'IEND', b''))
+
+
+def write_png_parallel(file_name, image, level=6, jobs=None):
+    """
+    多线程写入大图PNG(同pigz): 过滤后的数据按行分成条带，各条带在线程池中独立deflate，拼成一个合法的zlib流
+    每个条带以之前32KB数据为预设字典，以Z_SYNC_FLUSH结束在字节边界上，压缩率与单线程接近
+    zlib压缩时释放GIL，耗时随CPU核数下降
+    image: RGB图片按行做Up过滤，P图片按8位调色板写入、不过滤
+    """
+    width, height = image.size
+    if image.mode == 'P':
+        color_type, stride, filter_type = 3, width, b'\x00'
+        data = image.tobytes()
+    else:
+        image = rgb_image(image)
+        color_type, stride, filter_type = 2, width * 3, b'\x02'
+        # Up过滤: 每行减去上一行，首行减去全0行，整图在C中一次完成
+        above = ImageChops.offset(image, 0, 1)
+        above.paste((0, 0, 0), (0, 0, width, 1))
+        data = ImageChops.subtract_modulo(image, above).tobytes()
+    view = memoryview(data)
+    jobs = jobs or os.cpu_count() or 1
+    rows = -(-height // (jobs * 4))     # 条带数为线程数的4倍，平衡各线程的负载
+    window = -(-32768 // (stride + 1))  # 预设字典需要的行数
+
+    def raw(start, end):
+        return b''.join(filter_type + view[i * stride: (i + 1) * stride] for i in range(start, end))
+
+    def compress(start):
+        end = min(height, start + rows)
+        block = raw(start, end)
+        if start:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=raw(max(0, start - window), start)[-32768:])
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(block) + compressor.flush(zlib.Z_FINISH if end == height else zlib.Z_SYNC_FLUSH)
+        return data, zlib.adler32(block), len(block)
+
+    # zlib头: CMF为32KB窗口的deflate，FLG的压缩级别只是提示，校验位使头部能被31整除
+    flg = (0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3) << 6
+    header = bytes((0x78, flg + 31 - (0x78 * 256 + flg) % 31))
+    adler = 1
+    with open(file_name, 'wb') as f, ThreadPoolExecutor(jobs) as pool:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)))
+        if color_type == 3:
+            f.write(png_chunk(b'PLTE', bytes(image.getpalette()[:768])))
+        f.write(png_chunk(b'IDAT', header))
+        for data, checksum, length in pool.map(compress, range(0, height, rows)):
+            f.write(png_chunk(b'IDAT', data))
+            adler = adler32_combine(adler, checksum, length)
+        f.write(png_chunk(b'IDAT', struct.pack('>I', adler)))
+        f.write(png_chunk(b'IEND', b''))
+
+
+def list_monitors(root=None):
+    """
+    枚举各显示器在虚拟桌面中的范围，Linux使用XRandR，Windows使用EnumDisplayMonitors
+    获取失败时把整个屏幕作为一个显示器
+    return: [(x1, y1, x2, y2), ...]
+    """
+    monitors = []
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+
+        def callback(handle, dc, rect, data):
+            r = rect.contents
+            monitors.append((r.left, r.top, r.right, r.bottom))
+            return 1
+        proc = ctypes.WINFUNCTYPE(ctypes.c_int, wintypes.HMONITOR, wintypes.HDC,
+                                  ctypes.POINTER(wintypes.RECT), wintypes.LPARAM)(callback)
+        ctypes.windll.user32.EnumDisplayMonitors(None, None, proc, 0)
+    elif os.name == 'posix':
+        try:
+            output = subprocess.run(['xrandr', '--listmonitors'], capture_output=True, text=True, timeout=2).stdout
+        except (OSError, subprocess.SubprocessError):
+            output = ''
+        # 例: " 0: +*DP-1 1920/527x1080/296+0+0  DP-1"
+        for w, h, x, y in re.findall(r'\s(\d+)/\d+x(\d+)/\d+\+(-?\d+)\+(-?\d+)', output):
+            x, y = int(x), int(y)
+            monitors.append((x, y, x + int(w), y + int(h)))
+    if not monitors and root is not None:
+        monitors.append((0, 0, root.winfo_screenwidth(), root.winfo_screenheight()))
+    return monitors
+
+
+def monitor_at(monitors, x, y):
+    """
+    返回坐标所在的显示器，不在任何显示器内时返回第一个
+    """
+    for monitor in monitors:
+        if monitor[0] <= x < monitor[2] and monitor[1] <= y < monitor[3]:
+            return monitor
+    return monitors[0]
+
+
+def grab_screen(box):
+    """
+    截取虚拟桌面坐标box内的屏幕，Windows下ImageGrab默认只能截主屏，区域超出主屏时才截取全部屏幕
+    """
+    all_screens = False
+    if os.name == 'nt':
+        import ctypes
+        metrics = ctypes.windll.user32.GetSystemMetrics
+        all_screens = box[0] < 0 or box[1] < 0 or box[2] > metrics(0) or box[3] > metrics(1)
+    return ImageGrab.grab(box, all_screens=all_screens)
+
+
+def save_image(image, file_name, webp=False):
+    """
+    按内容选择编码保存截图，记录编码耗时和文件大小:
+        不超过256色(常见的界面截图): 无损转为调色板PNG，位深可降到1/2/4/8位
+        超过256色(照片、渐变): RGB PNG，使用较快的压缩级别；webp为True或文件名后缀为.webp时保存为无损WebP
+    颜色统计由getcolors在C中完成，超过256色时立即返回
+    像素数超过Style.png_parallel_pixels的PNG由write_png_parallel多线程压缩
+    return: 实际保存的文件路径，webp为True时后缀可能改为.webp
+    """
+    st = time.perf_counter()
+    image = rgb_image(image)
+    colors = image.getcolors(256)
+    parallel = Style.png_parallel_pixels and image.width * image.height >= Style.png_parallel_pixels
+    if colors is None and webp:
+        file_name = os.path.splitext(file_name)[0] + '.webp'
+    if file_name.lower().endswith('.webp'):
+        kind = 'lossless webp'
+        image.save(file_name, 'WEBP', lossless=True, method=4)
+    elif colors and (quantized := exact_palette(image, len(colors))) is not None:
+        kind = f'palette png ({len(colors)} colors)'
+        if parallel:
+            write_png_parallel(file_name, quantized, 9)
+        else:
+            quantized.save(file_name, 'PNG', compress_level=9)
+    else:
+        kind = 'rgb png'
+        if parallel:
+            write_png_parallel(file_name, image, Style.png_level)
+        else:
+            image.save(file_name, 'PNG', compress_level=Style.png_level)
+    if parallel and not file_name.lower().endswith('.webp'):
+        kind += f' ({os.cpu_count()} threads)'
+    logger.info('%s: %dx%d %s, %s in %.1f ms', file_name, *image.size, kind,
+                format_size(os.path.getsize(file_name)), (time.perf_counter() - st) * 1000)
+    return file_name
+
+
+def exact_palette(image, count):
+    """
+    不超过256色的RGB图片无损转为调色板图片
+    按调色板取最近色的映射会把相近的颜色合并，改用中位切分: 颜色数不超过调色板大小时每种颜色独占一项
+    转换后逐像素核对，有任何偏差时返回None，由调用方保存为RGB
+    count: 图片的颜色数
+    """
+    quantized = image.quantize(count, method=Image.MEDIANCUT, dither=Image.NONE)
+    if ImageChops.difference(quantized.convert('RGB'), image).getbbox():
+        logger.info('palette conversion is not exact, keep rgb')
+        return None
+    return quantized
+
+
+def rgb_image(image):
+    """
+    转换为RGB图片，已经是RGB时不复制
+    """
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+
+class HandlerProfiler(object):
+    """
+    交互界面回调的耗时统计：包装绑定到画布和主窗口的所有回调，记录每个回调的耗时分布、
+    事件频率和画布元素数量，会话结束时输出汇总，可选输出cProfile数据(pstats格式，可转火焰图)
+    """
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)    # 耗时直方图的区间上限（毫秒）
+
+    def __init__(self, summary_file=None, trace_file=None):
+        self.summary_file = summary_file
+        self.trace_file = trace_file
+        self.canvas = None
+        self.samples = {}       # 回调名 -> 每次耗时（毫秒）
+        self.items = {}         # 回调名 -> 回调结束时画布元素数量的最大值
+        self.start_time = time.perf_counter()
+        self.dumped = False
+        self.profile = None
+        if trace_file:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def wrap(self, func, name):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, (time.perf_counter() - start) * 1000)
+        return wrapper
+
+    def patch(self, widget):
+        """
+        包装控件的bind方法，画布还包装tag_bind，之后绑定的回调都会被计时
+        """
+        bind = widget.bind
+
+        def profiled_bind(sequence=None, func=None, add=None):
+            if func is not None:
+                func = self.wrap(func, f'{sequence} {getattr(func, "__qualname__", func)}')
+            return bind(sequence, func, add)
+        widget.bind = profiled_bind
+        if not hasattr(widget, 'tag_bind'):
+            return
+        tag_bind = widget.tag_bind
+
+        def profiled_tag_bind(tag_or_id, sequence=None, func=None, add=None):
+            if func is not None:
+                func = self.wrap(func, f'{tag_or_id}:{sequence} {getattr(func, "__qualname__", func)}')
+            return tag_bind(tag_or_id, sequence, func, add)
+        widget.tag_bind = profiled_tag_bind
+
+    def record(self, name, cost):
+        self.samples.setdefault(name, []).append(cost)
+        if self.canvas is not None:
+            try:
+                self.items[name] = max(self.items.get(name, 0), len(self.canvas.find_all()))
+            except tk.TclError:
+                pass
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        handlers = {}
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            histogram = [0] * (len(self.buckets) + 1)
+            for cost in samples:
+                histogram[bisect.bisect_left(self.buckets, cost)] += 1
+            handlers[name] = {
+                'count': len(samples),
+                'rate': len(samples) / elapsed,
+                'mean_ms': sum(samples) / len(samples),
+                'p50_ms': ordered[len(ordered) // 2],
+                'p95_ms': ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)],
+                'max_ms': ordered[-1],
+                'histogram': dict(zip([f'<={b}ms' for b in self.buckets] + [f'>{self.buckets[-1]}ms'], histogram)),
+                'canvas_items': self.items.get(name, 0)
+            }
+        return {'elapsed': elapsed, 'handlers': handlers}
+
+    def dump(self):
+        """
+        输出统计汇总，只输出一次
+        """
+        if self.dumped:
+            return
+        self.dumped = True
+        data = self.summary()
+        lines = [f"{'handler':<64}{'count':>7}{'rate/s':>8}{'p50ms':>8}{'p95ms':>8}{'maxms':>8}{'items':>7}"]
+        for name, item in sorted(data['handlers'].items(), key=lambda x: -x[1]['p95_ms']):
+            lines.append(f"{name[:63]:<64}{item['count']:>7}{item['rate']:>8.1f}{item['p50_ms']:>8.2f}"
+                         f"{item['p95_ms']:>8.2f}{item['max_ms']:>8.2f}{item['canvas_items']:>7}")
+        logger.info('handler profile (%.1fs):\n%s', data['elapsed'], '\n'.join(lines))
+        if self.summary_file:
+            with open(self.summary_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+        if self.profile:
+            self.profile.disable()
+            self.profile.dump_stats(self.trace_file)
+
+
+def check_mark(mark):
+    """
+    检查标记的类型和必需的字段，不合法时抛出ValueError，信息中带上该标记
+    return: 需要box的标记返回按左上、右下排好的box，其它标记返回None
+    """
+    fields = {'rectangle': ('box',), 'oval': ('box',), 'mosaic': ('box',), 'pixelate': ('box',),
+              'line': ('box',), 'arrow': ('box',), 'pen': ('points',), 'text': ('xy', 'text')}
+    kind = mark.get('type') if isinstance(mark, dict) else None
+    if kind not in fields:
+        raise ValueError(f'unknown mark type: {mark!r}')
+    missing = [field for field in fields[kind] if field not in mark]
+    if missing:
+        raise ValueError(f'{kind} mark without {", ".join(missing)}: {mark!r}')
+    if 'box' not in fields[kind]:
+        return None
+    box = mark['box']
+    if not isinstance(box, (list, tuple)) or len(box) != 4 or not all(isinstance(v, (int, float)) for v in box):
+        raise ValueError(f'bad box in {kind} mark: {mark!r}')
+    x1, y1, x2, y2 = box
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def render_marks(image, marks):
+    """
+    用Pillow在图片上绘制标记，样式与截图工具栏的标记一致
+    marks: 标记列表，每个标记为字典:
+        type: rectangle | oval | line | arrow | pen | text | mosaic | pixelate
+        box: [x1, y1, x2, y2]，pen使用points: [[x, y], ...]，text使用xy: [x, y]和text
+        color: Style.text_colors中的颜色名或序号，默认为当前选择的颜色
+        width: Style.mark_pi_values中的值(如"4pi")或序号，默认为当前选择的粗细
+        size: 文字字号，Style.text_pt_values中的值或序号
+        block: pixelate的像素块大小，默认10
+    带透明通道的图片以RGBA绘制，保留透明度，其它图片以RGB绘制
+    标记不合法时抛出ValueError，见check_mark
+    """
+    def pick(value, values):
+        return values[value] if isinstance(value, int) else value
+
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+    else:
+        image = rgb_image(image)
+    draw = ImageDraw.Draw(image)
+    for mark in marks:
+        box = check_mark(mark)
+        kind = mark['type']
+        color = Style.text_rgb[pick(mark.get('color', Style.choose_color), Style.text_colors)]
+        width = int(pick(mark.get('width', Style.choose_pi), Style.mark_pi_values).strip('pi'))
+        if kind == 'rectangle':
+            draw.rectangle(box, outline=color, width=width)
+        elif kind == 'oval':
+            draw.ellipse(box, outline=color, width=width)
+        elif kind == 'mosaic':
+            draw.rectangle(box, outline=color, fill=color, width=width)
+        elif kind == 'line':
+            draw.line(mark['box'], fill=color, width=width)
+        elif kind == 'arrow':
+            # 与canvas的arrowshape=(24, 28, 10)一致: 箭头颈部/尾部到尖端的距离及尾部的横向宽度
+            d1, d2, d3 = 24, 28, 10 + width / 2
+            x1, y1, x2, y2 = mark['box']
+            angle = math.atan2(y2 - y1, x2 - x1)
+            cos, sin = math.cos(angle), math.sin(angle)
+            neck = x2 - d1 * cos, y2 - d1 * sin
+            draw.line((x1, y1, *neck), fill=color, width=width)
+            draw.polygon(((x2, y2), (x2 - d2 * cos - d3 * sin, y2 - d2 * sin + d3 * cos), neck,
+                          (x2 - d2 * cos + d3 * sin, y2 - d2 * sin - d3 * cos)), fill=color)
+        elif kind == 'pen':
+            draw.line([tuple(point) for point in mark['points']], fill=color, width=width, joint='curve')
+        elif kind == 'text':
+            pt = int(pick(mark.get('size', Style.choose_pt), Style.text_pt_values).strip('pt'))
+            draw.text(tuple(mark['xy']), mark['text'], fill=color, font=load_font(pt * 4 // 3))
+        elif kind == 'pixelate':
+            block = mark.get('block', 10)
+            region = image.crop(box)
+            small = region.resize((max(1, region.width // block), max(1, region.height // block)), Image.BOX)
+            image.paste(small.resize(region.size, Image.NEAREST), box[:2])
+    return image
+
+
+def load_font(size):
+    """
+    加载批量标注文字使用的字体，找不到候选字体时使用Pillow默认字体
+    """
+    for name in Style.text_fonts:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+def render_marks_file(task):
+    """
+    进程池任务：读取图片，绘制标记后保存
+    task: (图片路径, 标记列表, 输出路径)
+    """
+    file_name, marks, output = task
+    with Image.open(file_name) as image:
+        render_marks(image, marks).save(output)
+    return output
+
+
+def batch_render(marks_file, files, output_dir=None, jobs=None):
+    """
+    批量标注：同一组标记用进程池绘制到多张图片
+    output_dir: 输出目录，不指定时输出到原图同目录的 <文件名>_marked.<后缀>
+    不合法的标记记录日志后跳过，其余标记照常绘制
+    """
+    with open(marks_file, 'r', encoding='utf-8') as f:
+        marks = json.load(f)
+    valid = []
+    for mark in marks:
+        try:
+            check_mark(mark)
+        except ValueError as e:
+            logger.error('%s: mark skipped: %s', marks_file, e)
+        else:
+            valid.append(mark)
+    marks = valid
+    tasks = []
+    for file_name in files:
+        name, ext = os.path.splitext(os.path.basename(file_name))
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            output = os.path.join(output_dir, name + ext)
+        else:
+            output = os.path.join(os.path.dirname(file_name), f'{name}_marked{ext}')
+        tasks.append((file_name, marks, output))
+    st = time.time()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(render_marks_file, task) for task in tasks]
+        failed = 0
+        for task, future in zip(tasks, futures):
+            try:
+                future.result()
+            except Exception:
+                failed += 1
+                logger.exception('%s: annotation failed', task[0])
+    logger.info('%d/%d images annotated in %.2fs', len(tasks) - failed, len(tasks), time.time() - st)
 
 
 class Event:
@@ -268,6 +923,217 @@ class CanvasText:
         self.update_rect()
 
 
+class MarkIndex(object):
+    """
+    标记的网格空间索引：按外接矩形把标记登记到覆盖的网格中，按坐标查找时只检查所在网格的标记
+    标记增加、移动、删除时增量更新，查找耗时与画布上的标记总数无关
+    """
+    cell = 64   # 网格边长（像素）
+
+    def __init__(self):
+        self.cells = {}     # (列, 行) -> 标记key集合
+        self.boxes = {}     # 标记key -> 外接矩形
+
+    def cells_of(self, box):
+        x1, y1, x2, y2 = (int(v // self.cell) for v in box)
+        return [(cx, cy) for cx in range(x1, x2 + 1) for cy in range(y1, y2 + 1)]
+
+    def add(self, key, box):
+        self.boxes[key] = box
+        for cell in self.cells_of(box):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        box = self.boxes.pop(key, None)
+        if box is None:
+            return
+        for cell in self.cells_of(box):
+            keys = self.cells[cell]
+            keys.discard(key)
+            if not keys:
+                del self.cells[cell]
+
+    def move(self, key, box):
+        self.remove(key)
+        self.add(key, box)
+
+    def query(self, x, y, pad=0):
+        """
+        return: 外接矩形(外扩pad)包含坐标的标记key，后画的标记在前
+        """
+        keys = self.cells.get((int(x // self.cell), int(y // self.cell)), ())
+        return sorted((key for key in keys if self.boxes[key][0] - pad <= x <= self.boxes[key][2] + pad
+                       and self.boxes[key][1] - pad <= y <= self.boxes[key][3] + pad), reverse=True)
+
+
+class RegionDetector(object):
+    """
+    从冻结截图检测界面边缘和矩形区域，在后台线程中预先计算，之后的查询都是常数时间
+        边缘图: 按segment像素分段统计水平/垂直边缘的强度，用于选框吸附
+        区域图: 长直线把屏幕划分成cell大小的网格，相连的非边界格子组成一个区域
+    """
+    segment = 16        # 边缘强度的分段长度
+    cell = 8            # 区域网格的边长
+    line_length = 32    # 划分区域的直线最小长度
+    threshold = 24      # 相邻像素灰度差超过该值视为边缘
+    snap_distance = 8   # 吸附的最大距离
+
+    def __init__(self, image):
+        self.ready = False
+        self.width, self.height = image.size
+        self.v_edges = None     # 垂直边缘强度，每segment行一组，每组width个值
+        self.h_edges = None     # 水平边缘强度，每行一组，每组width//segment个值
+        self.rows = None        # 网格每行的非边界游程: (起点列表, 终点列表, 区域编号列表)
+        self.regions = []       # 区域编号 -> 区域坐标，过小或过大的区域为None
+        self.grid_width = self.width // self.cell
+        create_thread(self.detect, (image,))
+
+    def detect(self, image):
+        w, h, seg, cell = self.width, self.height, self.segment, self.cell
+        gray = image.convert('L')
+        lut = [255 if v > self.threshold else 0 for v in range(256)]
+        v_image = ImageChops.difference(gray, ImageChops.offset(gray, 1, 0)).point(lut)
+        h_image = ImageChops.difference(gray, ImageChops.offset(gray, 0, 1)).point(lut)
+        self.v_edges = v_image.resize((w, max(1, h // seg)), Image.BOX).tobytes()
+        self.h_edges = h_image.resize((max(1, w // seg), h), Image.BOX).tobytes()
+
+        # 只保留长直线作为区域边界，文字等短边缘不影响区域划分
+        # 格子内有任一直线像素即为边界格，再膨胀一格封住对角的缝隙，防止区域从角上连到外面
+        grid_size = (self.grid_width, h // cell)
+        box = (0, 0, grid_size[0] * cell, grid_size[1] * cell)
+        walls = ImageChops.lighter(self.long_lines(h_image.crop(box), 1, 0), self.long_lines(v_image.crop(box), 0, 1))
+        walls = walls.point([0] + [255] * 255).filter(ImageFilter.MaxFilter(3))
+        self.regions = self.label_regions(walls.tobytes(), *grid_size)
+        self.ready = True
+
+    def long_lines(self, edges, dx, dy, step=4):
+        """
+        只保留沿(dx, dy)方向不短于line_length的边缘，返回网格大小的图，非0的格子含有长直线
+        先沿直线方向缩小step倍(step个像素都是边缘才保留)，再做形态学开运算: 先腐蚀再膨胀，
+        每步与平移后的自身取最小/最大值，平移量倍增，全部在C中整图完成
+        edges: 尺寸为cell整数倍的二值边缘图
+        """
+        image = edges.reduce((step if dx else 1, step if dy else 1)).point([0] * 255 + [255])
+        length = self.line_length // step - 1      # 缩小时线段两端各可能损失不满step的部分
+        shifts, total = [], 1
+        while total < length:
+            shift = min(total, length - total)
+            shifts.append(shift)
+            total += shift
+        for shift in shifts:
+            image = ImageChops.darker(image, ImageChops.offset(image, -shift * dx, -shift * dy))
+        for shift in shifts:
+            image = ImageChops.lighter(image, ImageChops.offset(image, shift * dx, shift * dy))
+        return image.reduce((self.cell // step if dx else self.cell, self.cell // step if dy else self.cell))
+
+    def label_regions(self, walls, gw, gh):
+        """
+        网格连通域标记，返回每个连通域吸附到边缘后的外接矩形
+        按行的游程标记: 每行的非边界游程由正则在C中找出，与上一行列区间重叠的游程用并查集合并
+        结果保存在self.rows，每行为(游程起点列表, 游程终点列表, 区域编号列表)
+        """
+        cell, parent, boxes, rows = self.cell, [], [], []
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        previous = ([], [], [])
+        for cy in range(gh):
+            starts, ends, ids = [], [], []
+            for match in re.finditer(rb'\x00+', walls[cy * gw: (cy + 1) * gw]):
+                x1, x2 = match.span()
+                rid = len(parent)
+                parent.append(rid)
+                boxes.append((x1, cy, x2, cy + 1))
+                k = bisect.bisect_right(previous[1], x1)    # 上一行第一个终点在x1之后的游程
+                while k < len(previous[0]) and previous[0][k] < x2:
+                    root = find(previous[2][k])
+                    if root != find(rid):
+                        parent[find(rid)] = root
+                    k += 1
+                starts.append(x1)
+                ends.append(x2)
+                ids.append(rid)
+            rows.append((starts, ends, ids))
+            previous = rows[-1]
+
+        merged = {}
+        for rid, (x1, y1, x2, y2) in enumerate(boxes):
+            box = merged.setdefault(find(rid), [x1, y1, x2, y2])
+            box[:] = min(box[0], x1), min(box[1], y1), max(box[2], x2), max(box[3], y2)
+        index, regions = {}, []
+        for root, (x1, y1, x2, y2) in merged.items():
+            index[root] = len(regions)
+            if x2 - x1 < 3 or y2 - y1 < 3 or (x2 - x1) * (y2 - y1) > gw * gh * 0.9:
+                regions.append(None)
+                continue
+            # 边界膨胀使区域每边缩进了一格，边缘在外侧相邻的边界格内，从该格中心开始在一格范围内吸附
+            half = cell * 3 // 2
+            x1, y1, x2, y2 = x1 * cell - half, y1 * cell - half, x2 * cell + half, y2 * cell + half
+            # 边框有内外两条边缘时取外侧的，选中整个窗口
+            regions.append((self.snap_x(x1, (y1 + y2) // 2, cell, -1), self.snap_y((x1 + x2) // 2, y1, cell, -1),
+                            self.snap_x(x2, (y1 + y2) // 2, cell, 1), self.snap_y((x1 + x2) // 2, y2, cell, 1)))
+        self.rows = [(starts, ends, [index[find(rid)] for rid in ids]) for starts, ends, ids in rows]
+        return regions
+
+    def snap_x(self, x, y, distance=None, prefer=0):
+        """
+        在x附近查找最强的垂直边缘，没有时返回原坐标
+        prefer: 强度相同时的取舍，0取最近的，-1/1取更小/更大的坐标
+        """
+        if self.v_edges is None:
+            return x
+        distance = distance or self.snap_distance
+        row = min(int(y) // self.segment, len(self.v_edges) // self.width - 1) * self.width
+        x = int(x)
+        best, best_value = x, 160
+        for nx in range(max(0, x - distance), min(self.width, x + distance + 1)):
+            value = self.v_edges[row + nx]
+            if value > best_value or (value == best_value and self.closer(nx, best, x, prefer)):
+                best, best_value = nx, value
+        return best
+
+    def snap_y(self, x, y, distance=None, prefer=0):
+        """
+        在y附近查找最强的水平边缘，没有时返回原坐标
+        prefer: 同snap_x
+        """
+        if self.h_edges is None:
+            return y
+        distance = distance or self.snap_distance
+        columns = len(self.h_edges) // self.height
+        col = min(int(x) // self.segment, columns - 1)
+        y = int(y)
+        best, best_value = y, 160
+        for ny in range(max(0, y - distance), min(self.height, y + distance + 1)):
+            value = self.h_edges[ny * columns + col]
+            if value > best_value or (value == best_value and self.closer(ny, best, y, prefer)):
+                best, best_value = ny, value
+        return best
+
+    @staticmethod
+    def closer(candidate, best, origin, prefer):
+        if prefer:
+            return (candidate - best) * prefer > 0
+        return abs(candidate - origin) < abs(best - origin)
+
+    def region_at(self, x, y):
+        """
+        获取坐标所在的区域，未检测完成或没有区域时返回None
+        """
+        if not self.ready:
+            return None
+        cx, cy = int(x) // self.cell, int(y) // self.cell
+        if not (0 <= cx < self.grid_width and 0 <= cy < len(self.rows)):
+            return None
+        starts, ends, ids = self.rows[cy]
+        k = bisect.bisect_right(starts, cx) - 1
+        return self.regions[ids[k]] if k >= 0 and cx < ends[k] else None
+
+
 class UnFillRectangle(object):
     """
     用4个toplevel创建的矩形框，不会覆盖屏幕
@@ -311,19 +1177,690 @@ class UnFillRectangle(object):
             widget.destroy()
 
 
+class ScreenHistory(object):
+    """
+    截图历史记录：按内容哈希去重，元数据逐行追加到索引文件，缩略图使用有界LRU缓存
+    磁盘缩略图数量也有上限，超出时先删原图已不存在的，再删最久没用过的
+    """
+    index_file = 'history.jsonl'
+    thumb_dir = '.thumbs'
+    thumb_size = (160, 100)
+    thumb_limit = 2000      # 磁盘缩略图的数量上限
+
+    def __init__(self, folder='img', cache_size=200):
+        self.folder = folder
+        self.cache_size = cache_size
+        self.records = None             # 内容哈希 -> 元数据，按最近截图时间排序
+        self.thumbs = OrderedDict()     # 内容哈希 -> 缩略图，LRU顺序
+        self.thumb_count = None         # 磁盘缩略图数量，第一次生成缩略图时统计
+        self.index_lines = 0
+
+    def load(self):
+        """
+        读取索引文件，同一哈希以最后一行为准；重复行过多时压缩索引文件
+        """
+        if self.records is not None:
+            return
+        self.records = OrderedDict()
+        path = os.path.join(self.folder, self.index_file)
+        if not os.path.isfile(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.records.pop(record['hash'], None)
+                self.records[record['hash']] = record
+                self.index_lines += 1
+        if self.index_lines > 2 * len(self.records) + 100:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(record) + '\n' for record in self.records.values())
+            self.index_lines = len(self.records)
+
+    def add(self, image, region):
+        """
+        保存截图，内容相同的截图只保存一次文件
+        region: 截图的屏幕区域
+        return: 截图文件路径
+        """
+        self.load()
+        digest = image_digest(image)
+        record = self.records.pop(digest, None)
+        if record is None or not os.path.isfile(os.path.join(self.folder, record['file'])):
+            os.makedirs(self.folder, exist_ok=True)
+            file_name = '%s_%s.png' % (time.strftime('%Y%m%d%H%M%S', time.localtime()), digest[:6])
+            file_name = save_image(image, os.path.join(self.folder, file_name), webp=Style.save_webp)
+            record = {
+                'hash': digest,
+                'file': os.path.basename(file_name),
+                'region': [int(i) for i in region],
+                'size': list(image.size)
+            }
+        record['time'] = int(time.time())
+        self.records[digest] = record
+        with open(os.path.join(self.folder, self.index_file), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+        self.index_lines += 1
+        return os.path.join(self.folder, record['file'])
+
+    def latest(self, start=0, count=20):
+        """
+        按时间倒序分页获取历史记录
+        """
+        self.load()
+        return list(itertools.islice(reversed(self.records.values()), start, start + count)), len(self.records)
+
+    def file(self, record):
+        return os.path.join(self.folder, record['file'])
+
+    def thumbnail(self, record):
+        """
+        获取缩略图：先查内存LRU缓存，再查磁盘缩略图，都没有时才解码原图生成
+        """
+        digest = record['hash']
+        if digest in self.thumbs:
+            self.thumbs.move_to_end(digest)
+            return self.thumbs[digest]
+        thumb_file = os.path.join(self.folder, self.thumb_dir, f'{digest}.png')
+        if os.path.isfile(thumb_file):
+            thumb = Image.open(thumb_file)
+            thumb.load()
+            os.utime(thumb_file)    # 修改时间作为最近使用时间，清理时保留常用的
+        else:
+            thumb = Image.open(self.file(record))
+            thumb.draft('RGB', self.thumb_size)
+            thumb.thumbnail(self.thumb_size)
+            os.makedirs(os.path.dirname(thumb_file), exist_ok=True)
+            thumb.save(thumb_file)
+            if self.thumb_count is None:
+                self.thumb_count = len(os.listdir(os.path.dirname(thumb_file)))
+            else:
+                self.thumb_count += 1
+            if self.thumb_count > self.thumb_limit:
+                self.prune_thumbs()
+        self.thumbs[digest] = thumb
+        if len(self.thumbs) > self.cache_size:
+            self.thumbs.popitem(last=False)
+        return thumb
+
+    def prune_thumbs(self):
+        """
+        磁盘缩略图删到上限的90%: 先删原图已不在历史中的，再按最近使用时间删最旧的
+        """
+        self.load()
+        entries = []
+        for entry in os.scandir(os.path.join(self.folder, self.thumb_dir)):
+            record = self.records.get(os.path.splitext(entry.name)[0])
+            alive = record is not None and os.path.isfile(self.file(record))
+            entries.append((alive, entry.stat().st_mtime, entry.path))
+        entries.sort()
+        remove = max(0, len(entries) - int(self.thumb_limit * 0.9))
+        for _, _, path in entries[:remove]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.thumb_count = len(entries) - remove
+        logger.info('history: removed %d thumbnails', remove)
+
+
+class FrameStore(object):
+    """
+    录屏帧存储：全部帧顺序写入单个临时文件，避免每帧创建文件和编码图片
+        level为0: 原始RGBX像素按第一帧尺寸固定步长存储，导出时通过mmap零拷贝读取
+        level为1-9: 每帧使用zlib快速压缩后存储，偏移表保存在内存，录制中可以调整压缩级别和帧尺寸
+    """
+
+    def __init__(self, level=0):
+        self.level = level
+        self.mode = 'RGB' if level else 'RGBX'
+        self.size = None
+        self.offsets = []       # 每帧在文件中的(偏移, 长度, 尺寸)
+        self.times = []         # 每帧的抓取时间，导出时按实际间隔计算帧时长
+        self.position = 0
+        self.mmap = None
+        self.lock = threading.Lock()
+        fd, self.path = tempfile.mkstemp(prefix='tk_capture_', suffix='.frames')
+        self.file = os.fdopen(fd, 'w+b')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, image, stamp=None):
+        """
+        追加一帧，不压缩时尺寸以第一帧为准
+        stamp: 抓取时间，不指定时为当前时间
+        """
+        image = rgb_image(image)
+        if self.size is None:
+            self.size = image.size
+        elif image.size != self.size and not self.level:
+            image = image.resize(self.size)
+        data = image.tobytes('raw', self.mode)
+        level = self.level
+        if level:
+            data = zlib.compress(data, level)
+        with self.lock:
+            self.file.write(data)
+        self.times.append(time.time() if stamp is None else stamp)
+        self.offsets.append((self.position, len(data), image.size))
+        self.position += len(data)
+
+    def finish(self):
+        """
+        录制结束，映射整个帧文件用于导出
+        """
+        self.file.flush()
+        if self.position:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, index):
+        """
+        读取一帧，未压缩时返回直接引用映射内存的只读图片
+        """
+        offset, length, size = self.offsets[index]
+        if self.mmap is None:
+            # 录制中读取，直接从文件读取
+            with self.lock:
+                self.file.flush()
+                position = self.file.tell()
+                self.file.seek(offset)
+                data = self.file.read(length)
+                self.file.seek(position)
+        else:
+            data = memoryview(self.mmap)[offset: offset + length]
+        if self.level:
+            return Image.frombytes(self.mode, size, zlib.decompress(data))
+        return Image.frombuffer(self.mode, size, data, 'raw', self.mode, 0, 1)
+
+    def close(self):
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass    # 仍有图片引用映射内存，交由垃圾回收释放
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class LongCapture(object):
+    """
+    滚动长截图：滚动过程中反复截取选框区域，用行哈希查找相邻两次截图的重叠行数后拼接
+    新增的行直接追加到临时文件，最后分块流式写成PNG，内存占用与页面长度无关
+    """
+
+    def __init__(self, master):
+        self.master = master
+        self.area_box = None
+        self.rect = None
+        self.height = 0
+        self.stop_flag = False
+        self.cancel_flag = False
+        self.is_capturing = False
+
+    def init(self, area_box):
+        self.area_box = area_box
+        self.rect = UnFillRectangle(self.master, area_box, bg=Style.theme_color)
+
+    @staticmethod
+    def row_hashes(data, stride):
+        """
+        每行像素的crc32哈希
+        """
+        view = memoryview(data)
+        return [zlib.crc32(view[i: i + stride]) for i in range(0, len(view), stride)]
+
+    @staticmethod
+    def find_overlap(prev, cur, min_rows=8):
+        """
+        查找上一次截图底部与本次截图顶部的重叠行数，从最大重叠开始校验
+        return: 重叠行数，两次截图相同时为总行数，找不到时为0
+        """
+        if prev == cur:
+            return len(cur)
+        last, count = prev[-1], len(prev)
+        for j in range(min(len(cur), count) - 1, min_rows - 2, -1):
+            if cur[j] == last and prev[count - j - 1:] == cur[:j + 1]:
+                return j + 1
+        return 0
+
+    def start(self, auto_scroll=True):
+        """
+        开始滚动截取，自动滚动时连续多次画面不再变化则认为已到底部
+        return: 长截图文件路径，取消或没有截图时为None
+        """
+        self.is_capturing = True
+        x1, y1, x2, y2 = self.area_box
+        strips = tempfile.TemporaryFile()
+        last_hashes, width, still = None, 0, 0
+        while not self.stop_flag and not self.cancel_flag:
+            image = rgb_image(grab_screen(self.area_box))
+            width, data = image.width, image.tobytes()
+            hashes = self.row_hashes(data, width * 3)
+            overlap = self.find_overlap(last_hashes, hashes) if last_hashes else 0
+            if overlap >= len(hashes):
+                still += 1
+                if auto_scroll and still >= 3:
+                    break
+            else:
+                still = 0
+                strips.write(memoryview(data)[overlap * width * 3:])
+                self.height += len(hashes) - overlap
+                last_hashes = hashes
+            if auto_scroll:
+                pyautogui.scroll(-Style.long_scroll_clicks, x=(x1 + x2) // 2, y=(y1 + y2) // 2)
+            time.sleep(Style.long_interval)
+        self.rect.destroy()
+        self.is_capturing = False
+
+        file_name = None
+        if not self.cancel_flag and self.height:
+            os.makedirs('img', exist_ok=True)
+            file_name = 'img/%s_long.png' % time.strftime('%Y%m%d%H%M%S', time.localtime())
+            strips.seek(0)
+            write_png(file_name, width, self.height, iter(lambda: strips.read(width * 3 * 256), b''))
+            set_clipboard_image(file_name)
+        strips.close()
+        return file_name
+
+    def stop(self):
+        self.stop_flag = True
+
+    def cancel(self):
+        self.cancel_flag = True
+
+
+class AdaptiveController(object):
+    """
+    自适应录制：按统计窗口实测每帧耗时、写入队列深度、CPU占用和预估文件大小，
+    动态调整帧率、帧存储压缩级别和抓屏缩小比例，每次调整都记录日志
+    """
+    window = 1.0        # 统计窗口（秒）
+    max_depth = 8       # 写入队列超过该深度说明压缩写入跟不上
+    calm_windows = 3    # 连续多少个窗口有余量才恢复画质，避免来回调整
+    lookahead = 30      # 预估文件大小时按目前的增长速度再向后推算的秒数
+
+    def __init__(self, recorder, store, frames):
+        self.recorder = recorder
+        self.store = store
+        self.frames = frames
+        self.target_fps = self.fps = recorder.mode_info[recorder.mode][2]
+        self.max_level = store.level
+        self.start_time = self.window_start = time.time()
+        self.cpu_start = time.process_time()
+        self.window_frames = 0
+        self.calm = 0
+        self.size_time = self.start_time
+        self.estimating = False     # 预估线程是否在运行
+        self.projected = None       # 预估线程最近一次推算的文件大小，取用后清空
+
+    def adjust(self, name, old, new, reason):
+        logger.info('adaptive %s: %s -> %s (%s)', name, old, new, reason)
+        self.calm = 0
+
+    def set_level(self, level, reason):
+        self.adjust('compress level', self.store.level, level, reason)
+        self.store.level = level
+
+    def set_scale(self, scale, reason):
+        self.adjust('capture scale', f'1:{self.recorder.capture_scale}', f'1:{scale}', reason)
+        self.recorder.capture_scale = scale
+
+    def set_fps(self, fps, reason):
+        fps = max(2, min(self.target_fps, fps))
+        if fps != self.fps:
+            self.adjust('fps', self.fps, fps, reason)
+            self.fps = fps
+
+    def update(self):
+        """
+        每录制一帧调用一次，统计窗口结束时评估并调整
+        """
+        self.window_frames += 1
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed < self.window:
+            return
+        rec = self.recorder
+        fps = self.window_frames / elapsed
+        cpu = (time.process_time() - self.cpu_start) / elapsed
+        depth = self.frames.qsize()
+        cost = max(0.0, elapsed / self.window_frames - (rec.frame_sleep or 0))    # 每帧实际工作耗时
+        state = f'{fps:.1f} fps, queue {depth}, cpu {cpu:.0%}'
+        if depth > self.max_depth and self.store.level > 1:
+            self.set_level(self.store.level - 1, state)
+        elif (depth > self.max_depth or (fps < self.fps * 0.9 and cost > 1 / self.fps)) and rec.capture_scale < 4:
+            self.set_scale(rec.capture_scale + 1, state)
+        elif Style.adaptive_cpu and cpu > Style.adaptive_cpu:
+            self.set_fps(int(self.fps * 0.8), state)
+        elif depth == 0 and fps >= self.fps * 0.95 and (not Style.adaptive_cpu or cpu < Style.adaptive_cpu * 0.6):
+            self.calm += 1
+            if self.calm >= self.calm_windows:
+                if rec.capture_scale > 1:
+                    self.set_scale(rec.capture_scale - 1, state)
+                elif self.store.level < self.max_level:
+                    self.set_level(self.store.level + 1, state)
+                elif self.fps < self.target_fps:
+                    self.set_fps(self.fps + 1, state)
+        if Style.adaptive_size and now - self.size_time > 5 and not self.estimating:
+            # 预估需要编码样本帧，放到单独线程，不拖慢抓屏循环
+            self.size_time, self.estimating = now, True
+            create_thread(self.estimate, (now - self.start_time,))
+        if self.projected is not None:
+            projected, self.projected = self.projected, None
+            if projected > Style.adaptive_size * 1024 * 1024:
+                reason = f'projected size {format_size(projected)}'
+                if self.fps > 2:
+                    self.set_fps(int(self.fps * 0.8), reason)
+                elif rec.capture_scale < 4:
+                    self.set_scale(rec.capture_scale + 1, reason)
+        rec.frame_sleep = max(0.0, 1 / self.fps - cost)
+        self.window_start, self.window_frames, self.cpu_start = now, 0, time.process_time()
+
+    def estimate(self, elapsed):
+        """
+        预估线程: 按目前的增长速度推算再录制lookahead秒(不超过时长限制)时的文件大小，结果由update读取
+        不按时长限制推算，否则录制刚开始时会按录满时长的大小过早降低画质
+        """
+        rec = self.recorder
+        try:
+            horizon = min(elapsed + self.lookahead, rec.mode_info[rec.mode][3])
+            self.projected = rec.estimate_size() * horizon / elapsed
+        finally:
+            self.estimating = False
+
+
+class FrameEditor(object):
+    """
+    录屏导出前的帧编辑器：删除开头结尾、删除帧区间、裁剪画面
+    编辑结果只是导出帧的序号映射，删掉的帧不会被解码和编码
+    预览图按需解码并LRU缓存，拖动几千帧的时间轴也不卡顿
+    """
+    preview_size = (640, 360)       # 预览区域的最大尺寸
+    timeline_height = 24
+    cache_size = 64                 # 缓存的预览图数量
+
+    def __init__(self, master, store, indexes):
+        self.master = master
+        self.store = store
+        self.indexes = indexes                              # 可导出的帧序号
+        self.keep = bytearray(b'\x01') * len(indexes)       # 每帧是否保留
+        self.position = 0                                   # 当前预览的帧
+        self.mark = None                                    # 删除区间的起点
+        self.crop = None                                    # 裁剪框，为帧尺寸的比例 (left, top, right, bottom)
+        self.thumbs = OrderedDict()                         # 帧位置 -> 预览图，LRU
+        self.show_after_id = None
+        self.result = None
+        self.done = threading.Event()
+        width, height = store.size
+        ratio = min(self.preview_size[0] / width, self.preview_size[1] / height, 1)
+        self.view_size = max(1, int(width * ratio)), max(1, int(height * ratio))
+        self.window = self.canvas = self.timeline = self.photo = self.info = None
+        self.crop_start = None
+
+    def ask(self):
+        """
+        在主线程中打开编辑器，阻塞等待编辑结束
+        return: (导出的帧序号, 裁剪框)，取消时为None
+        """
+        self.master.after(0, self.build)
+        self.done.wait()
+        return self.result
+
+    def build(self):
+        self.window = tk.Toplevel(self.master)
+        self.window.title('TkCapture')
+        self.window.attributes('-topmost', 1)
+        self.window.protocol('WM_DELETE_WINDOW', self.cancel)
+        width, height = self.view_size
+        self.canvas = tk.Canvas(self.window, width=width, height=height, bg='Gray20', highlightthickness=0,
+                                cursor=Style.rect_cursor)
+        self.canvas.pack()
+        self.photo = ImageTk.PhotoImage('RGB', self.view_size)
+        self.canvas.create_image(0, 0, image=self.photo, anchor='nw')
+        self.canvas.bind('<Button-1>', self.crop_start_event)
+        self.canvas.bind('<B1-Motion>', self.crop_move_event)
+        self.canvas.bind('<ButtonRelease-1>', self.crop_end_event)
+        self.timeline = tk.Canvas(self.window, width=width, height=self.timeline_height, bg='Gray40',
+                                  highlightthickness=0)
+        self.timeline.pack(fill='x')
+        self.timeline.bind('<Button-1>', self.timeline_event)
+        self.timeline.bind('<B1-Motion>', self.timeline_event)
+        bar = tk.Frame(self.window, bg=Style.tool_bg)
+        bar.pack(fill='x')
+        self.info = tk.Label(bar, text='', font=(Style.font, 10), bg=Style.tool_bg, fg='Gray70')
+        self.info.pack(side='left', padx=5)
+        buttons = (
+            ('✓', 'OK', self.ok), ('✕', 'Exit', self.cancel), ('↺', 'Reset', self.reset),
+            ('⇥', 'Trim End', self.trim_end), ('✂', 'Delete Range', self.delete_range),
+            ('⌖', 'Mark', self.set_mark), ('⇤', 'Trim Start', self.trim_start)
+        )
+        for text, tip, command in buttons:
+            btn = BaseButton(bar, text=text, font=(Style.font, 14), bg=Style.tool_bg, width=3, command=command)
+            btn.pack(side='right', padx=2, pady=2)
+            Tip.enter_tips(btn, Style.get_language(tip))
+        self.window.bind('<Left>', lambda e: self.seek(self.position - 1))
+        self.window.bind('<Right>', lambda e: self.seek(self.position + 1))
+        self.window.bind('<Home>', lambda e: self.seek(0))
+        self.window.bind('<End>', lambda e: self.seek(len(self.keep) - 1))
+        self.window.bind('<Delete>', lambda e: self.delete_range())
+        self.window.bind('<Return>', lambda e: self.ok())
+        self.window.bind('<Escape>', lambda e: self.cancel())
+        self.draw_timeline()
+        self.seek(0)
+
+    def thumbnail(self, position):
+        """
+        解码并缩放一帧用于预览，只缓存最近使用的帧
+        """
+        if position in self.thumbs:
+            self.thumbs.move_to_end(position)
+            return self.thumbs[position]
+        image = rgb_image(self.store.read(self.indexes[position]))
+        image = image.resize(self.view_size, Image.BILINEAR, reducing_gap=2.0)
+        self.thumbs[position] = image
+        while len(self.thumbs) > self.cache_size:
+            self.thumbs.popitem(last=False)
+        return image
+
+    def seek(self, position):
+        """
+        移动到指定帧，拖动时间轴产生的多次移动合并为一次刷新
+        """
+        self.position = min(max(position, 0), len(self.keep) - 1)
+        width = self.timeline.winfo_width() or self.view_size[0]
+        x = self.position * width / len(self.keep)
+        self.timeline.coords('cursor', x, 0, x, self.timeline_height)
+        if self.show_after_id is None:
+            self.show_after_id = self.window.after_idle(self.show)
+
+    def show(self):
+        self.show_after_id = None
+        self.photo.paste(self.thumbnail(self.position))
+        state = '' if self.keep[self.position] else '  ✂'
+        self.info.configure(text=f'{self.position + 1}/{len(self.keep)}  ({sum(self.keep)}){state}')
+
+    def draw_timeline(self):
+        """
+        时间轴：保留的帧为主题色，删除的帧为灰色，标记点为白色
+        """
+        self.timeline.delete('all')
+        width = self.timeline.winfo_width() or self.view_size[0]
+        step = width / len(self.keep)
+        for keep, group in itertools.groupby(enumerate(self.keep), key=lambda x: x[1]):
+            if keep:
+                first = last = next(group)[0]
+                for last, _ in group:
+                    pass
+                self.timeline.create_rectangle(first * step, 2, (last + 1) * step, self.timeline_height - 2,
+                                               fill=Style.theme_color, outline='')
+        if self.mark is not None:
+            x = self.mark * step
+            self.timeline.create_line(x, 0, x, self.timeline_height, fill='Snow', width=2)
+        x = self.position * step
+        self.timeline.create_line(x, 0, x, self.timeline_height, fill='Red', width=2, tags='cursor')
+
+    def timeline_event(self, event):
+        self.seek(int(event.x * len(self.keep) / self.timeline.winfo_width()))
+
+    def set_frames(self, start, end, keep=0):
+        self.keep[start:end] = bytes([keep]) * (end - start)
+        self.draw_timeline()
+        self.seek(self.position)
+
+    def trim_start(self):
+        self.set_frames(0, self.position)
+
+    def trim_end(self):
+        self.set_frames(self.position + 1, len(self.keep))
+
+    def set_mark(self):
+        self.mark = self.position
+        self.draw_timeline()
+
+    def delete_range(self):
+        """
+        删除标记点与当前帧之间的帧（包含两端），没有标记时只删除当前帧
+        """
+        mark = self.position if self.mark is None else self.mark
+        self.mark = None
+        self.set_frames(min(mark, self.position), max(mark, self.position) + 1)
+
+    def reset(self):
+        self.mark = self.crop = None
+        self.canvas.delete('crop')
+        self.set_frames(0, len(self.keep), 1)
+
+    def crop_start_event(self, event):
+        self.crop_start = event.x, event.y
+        self.canvas.delete('crop')
+        self.canvas.create_rectangle(event.x, event.y, event.x, event.y, tags='crop', **Style.rectangle_style)
+
+    def crop_move_event(self, event):
+        width, height = self.view_size
+        x, y = min(max(event.x, 0), width), min(max(event.y, 0), height)
+        self.canvas.coords('crop', *self.crop_start, x, y)
+
+    def crop_end_event(self, event):
+        self.crop_move_event(event)
+        x1, y1, x2, y2 = self.canvas.coords('crop')
+        x1, x2 = sorted((x1, x2))
+        y1, y2 = sorted((y1, y2))
+        width, height = self.view_size
+        if x2 - x1 < 4 or y2 - y1 < 4:     # 单击取消裁剪
+            self.canvas.delete('crop')
+            self.crop = None
+        else:
+            self.crop = x1 / width, y1 / height, x2 / width, y2 / height
+
+    def ok(self):
+        indexes = [index for index, keep in zip(self.indexes, self.keep) if keep]
+        if indexes:
+            self.result = indexes, self.crop
+        self.close()
+
+    def cancel(self):
+        self.result = None
+        self.close()
+
+    def close(self):
+        self.thumbs.clear()
+        self.window.destroy()
+        self.done.set()
+
+
+class LossyFilter(object):
+    """
+    GIF有损压缩：在误差上限内让像素复用相邻的颜色，延长LZW能匹配的相同像素串
+        共用调色板: 各帧按同一个调色板减色，相同的像素在各帧得到相同的颜色
+        水平方向: 减色后与左侧像素的颜色相差不超过误差上限时改用该像素的颜色，重复几遍延长同色的行程，
+                 只和紧邻的像素比较，不打乱界面里本来就规则的花纹
+        时间方向: 最后与上一帧输出相差不超过误差上限的像素直接沿用上一帧的颜色序号，
+                 静止区域逐帧完全相同，GIF编码时成为透明像素
+    所有判断都用Pillow的整帧运算完成，误差始终相对于减色前的原图计算
+    """
+    passes = 4
+    refresh = 0.02      # 按共用调色板减色后超出误差上限两倍的像素比例超过该值时，按当前帧重建调色板
+
+    def __init__(self, budget):
+        self.lut = [255 if v <= budget else 0 for v in range(256)]
+        self.miss_lut = [0 if v <= budget * 2 else 255 for v in range(256)]
+        self.palette = None     # 共用调色板的P模式图片
+        self.previous = None    # 上一帧的输出
+
+    def difference(self, image1, image2):
+        """
+        两张RGB图片每个像素的最大通道差
+        return: L模式图片
+        """
+        r, g, b = ImageChops.difference(image1, image2).split()
+        return ImageChops.lighter(ImageChops.lighter(r, g), b)
+
+    def near(self, image1, image2):
+        """
+        两张RGB图片每个像素的最大通道差不超过误差上限的位置
+        return: 1位蒙版
+        """
+        return self.difference(image1, image2).point(self.lut, '1')
+
+    def quantize(self, image, colors):
+        """
+        image: 减色前的RGB图片
+        colors: 颜色数，预留一个颜色给GIF编码时的透明色
+        return: P模式图片
+        """
+        source = image
+        image = None
+        if self.palette is not None and self.palette.size == source.size:
+            image = source.quantize(palette=self.palette, dither=Image.NONE)
+            misses = self.difference(image.convert('RGB'), source).point(self.miss_lut).histogram()[255]
+            if misses > source.width * source.height * self.refresh:
+                image = None
+        if image is None:
+            image = self.palette = source.quantize(min(colors, 255), method=Image.FASTOCTREE)
+            self.previous = None        # 调色板变了，颜色序号不能沿用
+        image = self.runs(image, source)
+        if self.previous is not None:
+            image.paste(self.previous, mask=self.near(self.previous.convert('RGB'), source))
+        self.previous = image
+        return image
+
+    def runs(self, image, source):
+        """
+        image: 减色后的P模式图片
+        source: 减色前的RGB图片
+        """
+        if image.width < 2:
+            return image
+        for _ in range(self.passes):
+            shifted = ImageChops.offset(image, 1, 0)
+            mask = self.near(shifted.convert('RGB'), source)
+            mask.paste(0, (0, 0, 1, image.height))    # 左侧回绕过来的列不复用
+            image.paste(shifted, mask=mask)
+        return image
+
+
 class GifRecorder(object):
     mode_info = {
-        # 模式名: (转换的色彩格式，png压缩级别/jpeg的质量，帧率，时长限制)
+        # 模式名: (帧的色彩格式，帧存储压缩时的zlib压缩级别，帧率，时长限制)
         # 'Normal': ('P', 0, 10, 600),
-        'High Quality': ('RGBA', 6, 5, 300),
-        'High Frame Rate': ('', 75, 25, 120)
+        'High Quality': ('RGB', 1, 5, 300),
+        'High Frame Rate': ('RGB', 1, 25, 120),
+        'Timelapse': ('RGB', 1, 5, 4 * 3600),   # 帧率为回放帧率，采样间隔见Style.timelapse_interval
+        'Adaptive': ('RGB', 3, 15, 300)         # 帧率为目标帧率，压缩级别为最高级别，录制中自动调整
     }
 
     def __init__(self, master):
         self.master = master
         self.area_box = None
+        self.regions = []           # 多区域录制时各区域相对area_box(各区域的并集)的坐标，单区域时为空
         self.mode = None
-        self.rect = None
+        self.rects = []
         self.frame_sleep = None
         self.run_time = 0
         self.stop_flag = False
@@ -332,89 +1869,400 @@ class GifRecorder(object):
         self.is_asking = False
         self.is_saving = False
         self.progress = 0
+        self.store = None
+        self.store_lock = threading.Condition()     # 保护store和store_readers
+        self.store_readers = 0      # 正在读取帧存储的预估线程数，归零后start才关闭帧存储
+        self.export_scale = 1
+        self.export_fps = 0
+        self.export_colors = 256
+        self.export_crop = None     # 帧编辑器设置的裁剪框，为帧尺寸的比例
+        self.export_progress = {}   # 多路导出时各输出的进度，key为(区域序号, 格式)
+        self.capture_scale = 1      # 抓屏后立即缩小的倍数，之后的压缩、存储、导出都只处理缩小后的像素
+        self.capture_fps = None     # 预录制测得的(原始尺寸帧率, 缩小后帧率)
+
+    def create_store(self):
+        """
+        默认按原始像素存储；延时录制可能长达数小时，自适应录制中会改变帧尺寸，这两种模式始终压缩
+        """
+        lvl = self.mode_info[self.mode][1]
+        return FrameStore(lvl if Style.record_compress or self.mode in ('Timelapse', 'Adaptive') else 0)
+
+    @staticmethod
+    def write_frames(store, frames):
+        """
+        帧写入线程，压缩和写文件不占用抓屏线程
+        frames: (帧, 抓取时间)的队列
+        """
+        while (item := frames.get()) is not None:
+            store.append(*item)
+
+    def grab(self):
+        """
+        抓取录屏区域，需要时立即用box滤波整数倍缩小
+        """
+        image = grab_screen(self.area_box)
+        if self.capture_scale > 1:
+            image = image.reduce(self.capture_scale)
+        return image
 
-    def record(self, sec=0):
+    def record(self, sec=0, store=None):
         """
-        录屏实现
+        录屏实现：抓屏循环只负责抓屏，帧经队列交给写入线程存入帧存储
         sec: 录制时长限制（秒）
-        return: 录制的临时目录，录制帧数
+        store: 帧存储，不指定时新建
+        return: 帧存储，录制帧数
         """
+        if self.mode == 'Timelapse':
+            return self.record_timelapse(sec, store)
         start_time = time.time()
-        tmp_dir = str(int(start_time))
-        os.mkdir(tmp_dir)
+        store = store or self.create_store()
+        frames = queue.Queue(maxsize=32)
+        writer = create_thread(self.write_frames, (store, frames))
         x1, y1, x2, y2 = self.area_box
-        mode, lvl, _, limit = self.mode_info[self.mode]
-        limit = sec or limit
+        limit = sec or self.mode_info[self.mode][3]
+        controller = AdaptiveController(self, store, frames) if self.mode == 'Adaptive' and not sec else None
         index = 0
         while (not self.stop_flag) and (not self.cancel_flag) and (time.time() - start_time <= limit):
             pos = pyautogui.position()
-            image = ImageGrab.grab(self.area_box)
-            ImageDraw.Draw(image).polygon(
-                (pos[0] - x1, pos[1] - y1, pos[0] - x1, pos[1] - y1 + 18, pos[0] - x1 + 13, pos[1] - y1 + 13),
-                fill=(0, 0, 0, 150), outline=(200, 200, 200), width=2)
-            if mode:
-                image.convert(mode).save(f'{tmp_dir}/{index}', format='png', compress_level=lvl)
-            else:
-                image.save(f'{tmp_dir}/{index}', format='jpeg', quality=lvl)
+            stamp = time.time()
+            image = self.grab()
+            draw_cursor(image, pos[0] - x1, pos[1] - y1, self.capture_scale)
+            frames.put((image, stamp))
             index += 1
+            if controller:
+                controller.update()
             if self.frame_sleep:
                 time.sleep(self.frame_sleep)
             self.run_time = time.time() - start_time
-        return tmp_dir, index
+        frames.put(None)
+        writer.join()
+        store.finish()
+        return store, index
+
+    def record_timelapse(self, sec=0, store=None):
+        """
+        延时录制实现：按间隔采样，画面哈希变化超过阈值才保存该帧，磁盘占用只随画面变化增长
+        sec: 录制时长限制（秒）
+        store: 帧存储，不指定时新建
+        return: 帧存储，保存的帧数
+        """
+        start_time = time.time()
+        store = store or self.create_store()
+        limit = sec or self.mode_info[self.mode][3]
+        last_hash = None
+        next_time = start_time
+        while (not self.stop_flag) and (not self.cancel_flag) and (time.time() - start_time <= limit):
+            self.run_time = time.time() - start_time
+            if time.time() < next_time:
+                time.sleep(0.05)    # 分段休眠，保证停止按钮及时响应
+                continue
+            next_time += Style.timelapse_interval
+            image = self.grab()
+            frame_hash = image_hash(image, Style.timelapse_hash_size)
+            if last_hash is not None and hash_distance(frame_hash, last_hash) <= Style.timelapse_threshold:
+                continue
+            last_hash = frame_hash
+            store.append(image)
+        store.finish()
+        return store, len(store)
 
-    def init(self, area_box, mode):
+    def init(self, area_box, mode, regions=None):
         """
         录屏初始化，画矩形范围辅助框
         area_box: 录屏的区域坐标
         mode: 录制质量
-            清晰度优先: png格式图片，清晰度高，但帧率低
-            高帧率优先: jpg格式图片，清晰度低有噪点，但帧率高
+            清晰度优先: 帧率低，帧存储压缩率高
+            高帧率优先: 帧率高，帧存储使用最快的压缩级别
+            延时录制: 按间隔采样，只保留有变化的帧
+        regions: 同时录制的其它区域坐标，每帧只抓取一次所有区域的并集，导出时各区域分别输出到自己的文件
         """
-        self.area_box = area_box
+        boxes = [area_box, *(regions or [])]
+        self.area_box = (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                         max(b[2] for b in boxes), max(b[3] for b in boxes))
+        x1, y1 = self.area_box[:2]
+        self.regions = [(b[0] - x1, b[1] - y1, b[2] - x1, b[3] - y1) for b in boxes] if len(boxes) > 1 else []
         self.mode = mode
-        self.rect = UnFillRectangle(self.master, area_box, bg=Style.theme_color)
+        self.rects = [UnFillRectangle(self.master, box, bg=Style.theme_color) for box in boxes]
 
     def prepare(self):
         """
         预录制，计算出每帧的大致休眠时间，保证相对准确的帧率
         """
+        if self.mode == 'Timelapse':
+            self.frame_sleep = 0    # 延时录制按采样间隔自行计时，无需预录制
+            return
         sec = 4
         speed = self.mode_info[self.mode][2]
-        path, num = self.record(sec)
+        full_fps = None
+        if self.capture_scale > 1:
+            # 一半时间测原始尺寸的帧率，用于计算缩小带来的帧率提升
+            sec, scale, self.capture_scale = sec / 2, self.capture_scale, 1
+            store, num = self.record(sec)
+            store.close()
+            full_fps, self.capture_scale = num / sec, scale
+        store, num = self.record(sec)
         self.frame_sleep = max(0, (1000 / speed - 1000 * sec / num) / 1000)
-        shutil.rmtree(path)
+        store.close()
+        if full_fps:
+            self.capture_fps = (full_fps, num / sec)
+            logger.info('capture scale 1:%d: %.1f fps -> %.1f fps (+%.0f%%)', self.capture_scale,
+                        full_fps, num / sec, (num / sec / full_fps - 1) * 100)
         # print(f"{self.mode}: speed: {speed}, per sleep: {self.frame_sleep}")
 
+    def frame_indexes(self, store):
+        """
+        按导出帧率抽帧，返回需要导出的帧序号
+        按每帧的抓取时间划分1/export_fps的时间段，每段取第一帧，录制中帧率有变化时导出帧率仍然均匀
+        """
+        times = store.times[:len(store)]
+        if not self.export_fps or self.mode == 'Timelapse' or not times:
+            return list(range(len(times)))
+        indexes, last = [], None
+        for i, stamp in enumerate(times):
+            slot = int((stamp - times[0]) * self.export_fps + 1e-6)
+            if slot != last:
+                indexes.append(i)
+                last = slot
+        return indexes
+
+    def frame_durations(self, store, indexes):
+        """
+        导出时每帧的时长（毫秒）: 到下一个导出帧的抓取时间间隔，最后一帧取其它帧的平均值
+        延时录制按回放帧率使用固定时长
+        return: 帧序号 -> 时长，按编辑前的帧计算，删帧后剩余帧保持原时长，播放速度不变
+        """
+        if self.mode == 'Timelapse':
+            return dict.fromkeys(indexes, 1000 // self.mode_info[self.mode][2])
+        times = [store.times[i] for i in indexes]
+        durations = [round((b - a) * 1000) for a, b in zip(times, times[1:])]
+        durations.append(round(sum(durations) / len(durations)) if durations else round(self.run_time * 1000))
+        return dict(zip(indexes, (max(1, d) for d in durations)))
+
+    def export_image(self, image, quantize=True, size=None, lossy=None):
+        """
+        导出前处理单帧：按比例缩放，GIF按颜色数减色
+        size: 缩放前的基准尺寸，录制中帧尺寸有变化时统一缩放到该尺寸
+        lossy: GIF有损压缩的LossyFilter，同一次导出的所有帧共用
+        """
+        image = rgb_image(image)
+        width, height = size or image.size
+        if self.export_crop:
+            left, top, right, bottom = self.export_crop
+            w, h = image.size
+            image = image.crop((round(left * w), round(top * h), round(right * w), round(bottom * h)))
+            width, height = width * (right - left), height * (bottom - top)
+        size = max(1, int(width * self.export_scale)), max(1, int(height * self.export_scale))
+        if image.size != size:
+            image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+        if quantize:
+            image = self.quantize_image(image, lossy)
+        return image
+
+    def quantize_image(self, image, lossy=None):
+        """
+        GIF减色，有损压缩时由LossyFilter按共用调色板减色
+        """
+        if lossy:
+            return lossy.quantize(image, self.export_colors)
+        return image.quantize(self.export_colors, method=Image.FASTOCTREE)
+
+    @staticmethod
+    def lossy_filter(quantize=True):
+        return LossyFilter(Style.gif_lossy) if quantize and Style.gif_lossy else None
+
+    def estimate_size(self, samples=3, run=3):
+        """
+        预估导出GIF的大小：从导出帧中均匀抽取几段连续帧，按当前导出参数编码，再按帧数推算
+        GIF除首帧外只编码与上一帧的差异，每段样本连同前一帧编码，减去前一帧单独编码的大小即为差异帧的大小
+        只在取帧存储时持锁，编码期间登记为读者，start等读者归零后才关闭帧存储
+        return: 字节数
+        """
+        with self.store_lock:
+            store = self.store
+            if store is None:
+                return 0
+            indexes = self.frame_indexes(store)
+            self.store_readers += 1
+        try:
+            return self.estimate_store(store, indexes, samples, run)
+        finally:
+            with self.store_lock:
+                self.store_readers -= 1
+                self.store_lock.notify_all()
+
+    def estimate_store(self, store, indexes, samples, run):
+        if not indexes:
+            return 0
+
+        def encode(part):
+            buffer = io.BytesIO()
+            lossy = self.lossy_filter()
+            save_animation(buffer, (self.export_image(store.read(i), size=store.size, lossy=lossy) for i in part),
+                           100, format='gif')
+            return buffer.tell()
+
+        first = encode(indexes[:1])
+        if len(indexes) == 1:
+            return first
+        total, count = 0, 0
+        for k in range(samples):
+            start = max(1, (len(indexes) - 1) * k // samples + 1)
+            part = indexes[start - 1: start + run]
+            total += encode(part) - encode(part[:1])
+            count += len(part) - 1
+        return first + max(0, total) * (len(indexes) - 1) // count
+
     def start(self):
         """
         正式开始录制并选择保存的路径
         """
         self.is_recording = True
-        path, num = self.record()
+        self.store = self.create_store()
+        store, num = self.record(store=self.store)
         # print(f"frame number: {num}, except number: {int(self.run_time * self.mode_info[self.mode][2])}")
-        self.rect.destroy()
+        for rect in self.rects:
+            rect.destroy()
         self.is_recording = False
 
-        if not self.cancel_flag:
-            def image_generator():
-                for i in range(1, num):
-                    self.progress = i * 100 // num
-                    yield Image.open(f"{path}/{i}").convert('P')
-
+        if not self.cancel_flag and num:
             self.is_asking = True
-            file_name = filedialog.asksaveasfilename(
-                filetypes=[('Save Gif File', '*.gif')],
-                initialfile='%s.gif' % time.strftime('%Y%m%d%H%M%S', time.localtime()))
-            self.is_asking = False
+            indexes = self.frame_indexes(store)
+            durations = self.frame_durations(store, indexes)
+            file_name = None
+            edited = FrameEditor(self.master, store, indexes).ask() if Style.edit_switch else (indexes, None)
+            if edited:
+                indexes, self.export_crop = edited
+                if self.regions:
+                    self.export_crop = None     # 裁剪框针对的是并集画面，多区域导出时忽略
+                file_name = filedialog.asksaveasfilename(
+                    filetypes=[('Save Gif File', '*.gif'), ('Save WebP File', '*.webp'), ('Save APNG File', '*.png'),
+                               ('Save MP4 File', '*.mp4'), ('Save WebM File', '*.webm')],
+                    initialfile='%s.gif' % time.strftime('%Y%m%d%H%M%S', time.localtime()))
+            # 先置保存标志再清除询问标志，状态线程任何时候都不会误判为已结束而退出
             self.is_saving = True
+            self.is_asking = False
+            with self.store_lock:
+                self.store = None   # 不再开始新的预估
             if file_name:
-                st = time.time()
-                Image.open(f'{path}/0').convert('P').save(
-                    file_name, format='gif', save_all=True, append_images=image_generator(), optimize=True,
-                    duration=self.run_time * 1000 // num, loop=0)
-                # print(f'frame to gif cost time: {int(time.time()-st)}s')
-            self.is_saving = False
-        shutil.rmtree(path)
+                self.export(file_name, store, indexes, [durations[i] for i in indexes])
+        with self.store_lock:
+            self.store = None
+            self.store_lock.wait_for(lambda: not self.store_readers)
+        store.close()
+        self.is_saving = False
+
+    def export(self, file_name, store, indexes, durations):
+        """
+        多路导出：每帧只解码、裁剪、缩放一次，再分发给各格式的编码线程同时编码
+        总耗时接近最慢的单个编码器，而不是各编码器耗时之和
+        file_name: 所选的文件，Style.export_formats中的其它格式以相同文件名导出
+            多区域录制时第n个区域的文件名加后缀_n，所有区域共用同一组帧序号和帧时长
+        durations: 每个导出帧的时长（毫秒）
+        """
+        base, ext = os.path.splitext(file_name)
+        primary = {'.png': 'apng', '': 'gif'}.get(ext.lower(), ext.lower().lstrip('.'))
+        formats = [primary] + [fmt for fmt in Style.export_formats if fmt != primary]
+        regions = self.regions or [None]
+        outputs = {}    # (区域序号, 格式) -> 文件名
+        for n, region in enumerate(regions):
+            name = f'{base}_{n + 1}' if region else base
+            for fmt in formats:
+                outputs[n, fmt] = f"{name}{ext}" if fmt == primary else f"{name}.{'png' if fmt == 'apng' else fmt}"
+        queues = {key: queue.Queue(maxsize=8) for key in outputs}
+        self.export_progress = dict.fromkeys(outputs, 0)
+        threads = [create_thread(self.encode, (key, outputs[key], queues[key], len(indexes), durations))
+                   for key in outputs]
+        st = time.time()
+        for i in indexes:
+            frame = store.read(i)
+            for n, region in enumerate(regions):
+                image, size = self.region_image(frame, region, store.size)
+                image = self.export_image(image, False, size)
+                for fmt in formats:
+                    queues[n, fmt].put(image)
+        for frames in queues.values():
+            frames.put(None)
+        for th in threads:
+            th.join()
+        logger.info('export: %d frames of %d region(s) to %s in %.1fs', len(indexes), len(regions),
+                    ', '.join(formats), time.time() - st)
+
+    def region_image(self, frame, region, size):
+        """
+        从并集帧中切出单个区域
+        region: 区域相对并集的坐标(原始尺寸)，None为整帧
+        size: 并集帧的基准尺寸，帧经过capture_scale缩小时区域坐标按同一比例换算
+        return: (区域图片, 区域的基准尺寸)
+        """
+        if region is None:
+            return frame, size
+        union_width = self.area_box[2] - self.area_box[0]
+        ratio, base = frame.width / union_width, size[0] / union_width
+        box = tuple(round(v * ratio) for v in region)
+        return frame.crop(box), ((region[2] - region[0]) * base, (region[3] - region[1]) * base)
+
+    def encode(self, key, file_name, frames, count, durations):
+        """
+        单个输出的编码线程，从队列读取共享的RGB帧，出错时继续取空队列，不阻塞其它输出
+        key: (区域序号, 格式)
+        """
+        def images():
+            n = 0
+            while (image := frames.get()) is not None:
+                n += 1
+                self.export_progress[key] = n * 100 // count
+                self.progress = min(self.export_progress.values())
+                yield self.quantize_image(image, lossy) if fmt == 'gif' else image
+            finished.append(True)
+
+        fmt = key[1]
+        st = time.time()
+        lossy = self.lossy_filter(fmt == 'gif')
+        options = Style.export_options.get(fmt, {})
+        generator = images()
+        finished = []
+        try:
+            if fmt in ('gif', 'webp'):
+                save_animation(file_name, generator, durations, format=fmt, **options)
+            elif fmt == 'apng':
+                # PNG编码器会先遍历一遍append_images统计帧数，不能直接传入生成器
+                first, *rest = generator
+                first.save(file_name, format='png', save_all=True, append_images=rest, duration=durations,
+                           loop=0, **options)
+            else:
+                self.encode_video(file_name, generator, durations, options)
+            logger.info('export %s: %s in %.1fs', fmt, file_name, time.time() - st)
+        except Exception:
+            logger.exception('export %s failed: %s', fmt, file_name)
+            while not finished and frames.get() is not None:
+                pass
+        self.export_progress[key] = 100
+
+    @staticmethod
+    def encode_video(file_name, images, durations, options):
+        """
+        原始RGB帧通过管道交给ffmpeg编码视频
+        rawvideo输入只能是固定帧率: 按最短帧时长取帧率(不超过60)，按累计时长重复写入帧，各帧显示时长与录制时一致
+        """
+        first = next(images)
+        rate = min(60, max(1, round(1000 / min(durations))))
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+               '-s', '%dx%d' % first.size, '-r', str(rate), '-i', '-',
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', *options, file_name]
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        elapsed, written = 0, 0
+        try:
+            for image, duration in zip(itertools.chain([first], images), durations):
+                elapsed += duration
+                data = image.tobytes()
+                for _ in range(max(1, round(elapsed * rate / 1000) - written)):
+                    proc.stdin.write(data)
+                    written += 1
+        finally:
+            proc.stdin.close()
+            proc.wait()
+        if proc.returncode:
+            raise RuntimeError(f'ffmpeg exited with {proc.returncode}')
 
     def stop(self):
         self.stop_flag = True
@@ -426,38 +2274,358 @@ class GifRecorder(object):
         return self.frame_sleep is not None
 
 
+class ReplayBuffer(object):
+    """
+    即时回放：后台持续录制指定区域到内存环形缓冲，随时把最近N秒导出为GIF/WebP
+    每组帧由一个关键帧和之后与上一帧的差值帧组成，差值用subtract_modulo计算后zlib压缩，画面不变时不存数据
+    超过内存上限或保留时长时整组淘汰最旧的帧；抓屏和编码的耗时受CPU预算限制，超出时降低帧率
+    """
+
+    def __init__(self, area_box):
+        self.area_box = area_box
+        self.size = area_box[2] - area_box[0], area_box[3] - area_box[1]
+        self.groups = deque()   # 每组为[(时间, 是否关键帧, 数据), ...]，首帧为关键帧
+        self.memory = 0                     # 缓冲中所有帧数据的字节数
+        self.lock = threading.Lock()
+        self.stop_flag = False
+        self.interval = 1 / Style.replay_fps
+        self.stats = {'frames': 0, 'capture': 0.0, 'evicted': 0, 'evict': 0.0}
+
+    def grab(self):
+        image = rgb_image(grab_screen(self.area_box))
+        if pyautogui:
+            x, y = pyautogui.position()
+            draw_cursor(image, x - self.area_box[0], y - self.area_box[1])
+        return image
+
+    def run(self):
+        """
+        录制循环，每分钟输出一次抓屏耗时、帧率、内存和淘汰统计
+        """
+        last, count = None, 0
+        report = time.time() + 60
+        while not self.stop_flag:
+            st = time.perf_counter()
+            image = self.grab()
+            keyframe = last is None or count % Style.replay_keyframe == 0
+            if keyframe:
+                data = zlib.compress(image.tobytes(), 1)
+            else:
+                delta = ImageChops.subtract_modulo(image, last)
+                data = zlib.compress(delta.tobytes(), 1) if delta.getbbox() else b''
+            last, count = image, count + 1
+            self.append(time.time(), keyframe, data)
+            cost = time.perf_counter() - st
+            self.stats['frames'] += 1
+            self.stats['capture'] += cost
+            # CPU预算: 单帧耗时/间隔不超过预算，超出时拉长间隔，最快不超过目标帧率
+            self.interval = max(1 / Style.replay_fps, cost / Style.replay_cpu)
+            if time.time() > report:
+                self.report()
+                report = time.time() + 60
+            time.sleep(max(0.0, self.interval - cost))
+
+    def append(self, timestamp, keyframe, data):
+        with self.lock:
+            if keyframe:
+                self.groups.append([])
+            self.groups[-1].append((timestamp, keyframe, data))
+            self.memory += len(data)
+            st = time.perf_counter()
+            limit, oldest = Style.replay_memory * 1024 * 1024, timestamp - Style.replay_seconds
+            while len(self.groups) > 1 and (self.memory > limit or self.groups[1][0][0] < oldest):
+                group = self.groups.popleft()
+                self.memory -= sum(len(frame[2]) for frame in group)
+                self.stats['evicted'] += len(group)
+            self.stats['evict'] += time.perf_counter() - st
+
+    def report(self):
+        frames = self.stats['frames'] or 1
+        logger.info('replay: %.1f fps, capture %.1f ms/frame, %d frames in %s, evicted %d in %.2f ms',
+                    1 / self.interval, self.stats['capture'] * 1000 / frames, sum(len(g) for g in self.groups),
+                    format_size(self.memory), self.stats['evicted'], self.stats['evict'] * 1000)
+        self.stats = {'frames': 0, 'capture': 0.0, 'evicted': 0, 'evict': 0.0}
+
+    def frames(self, seconds):
+        """
+        解码最近seconds秒的帧，从所在组的关键帧开始依次累加差值
+        return: [(时间, 图片), ...]
+        """
+        start = time.time() - seconds
+        with self.lock:
+            groups = [list(group) for group in self.groups if group[-1][0] >= start]
+        frames = []
+        for group in groups:
+            image = None
+            for timestamp, keyframe, data in group:
+                if keyframe:
+                    image = Image.frombytes('RGB', self.size, zlib.decompress(data))
+                elif data:
+                    image = ImageChops.add_modulo(image, Image.frombytes('RGB', self.size, zlib.decompress(data)))
+                if timestamp >= start:
+                    frames.append((timestamp, image))
+        return frames
+
+    def dump(self, seconds, file_name=None):
+        """
+        把最近seconds秒导出为动图，文件名后缀为.webp时导出WebP
+        return: 文件路径，缓冲为空时为None
+        """
+        frames = self.frames(seconds)
+        if not frames:
+            return None
+        if not file_name:
+            os.makedirs('img', exist_ok=True)
+            file_name = 'img/%s_replay.gif' % time.strftime('%Y%m%d%H%M%S', time.localtime())
+        duration = (frames[-1][0] - frames[0][0]) * 1000 // max(1, len(frames) - 1) or 1000 // Style.replay_fps
+        save_animation(file_name, (image for _, image in frames), duration)
+        logger.info('replay: saved %d frames (%.1fs) to %s', len(frames), frames[-1][0] - frames[0][0], file_name)
+        return os.path.abspath(file_name)
+
+    def dump_command(self, header, payload):
+        """
+        seconds: 秒数，可以是数字字符串，必须是正数
+        file: 输出文件路径，可省略
+        """
+        try:
+            seconds = float(header.get('seconds', 10))
+        except (TypeError, ValueError):
+            raise ValueError(f"bad seconds: {header.get('seconds')!r}") from None
+        if not 0 < seconds < math.inf:
+            raise ValueError(f'bad seconds: {seconds!r}')
+        file_name = header.get('file')
+        if file_name is not None and not isinstance(file_name, str):
+            raise ValueError(f'bad file: {file_name!r}')
+        return {'file': self.dump(seconds, file_name)}
+
+    def serve(self):
+        """
+        前台运行回放缓冲，通过本地端口接收导出命令，Ctrl+C退出
+        """
+        server = socket.create_server(('127.0.0.1', Style.replay_port))
+        create_thread(serve_commands, (server, {'dump': self.dump_command}))
+        logger.info('replay: recording %s, listening on port %d', self.area_box, Style.replay_port)
+        try:
+            self.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+
+
+class ZoomPyramid(object):
+    """
+    贴图的缩放金字塔：按缩放级别缓存缩放后的图片，同一张图片的多个贴图共享
+    缩小从已缓存的最近的更大级别计算，放大从原图最近邻放大，保持像素清晰
+    """
+
+    def __init__(self, image, key=None):
+        self.image = image
+        self.key = key                  # 图片内容的摘要，PinBoard按它共享金字塔
+        self.levels = OrderedDict()     # 缩放比例 -> 图片，LRU
+
+    def get(self, scale):
+        if scale == 1:
+            return self.image
+        if scale in self.levels:
+            self.levels.move_to_end(scale)
+            return self.levels[scale]
+        size = (max(1, round(self.image.width * scale)), max(1, round(self.image.height * scale)))
+        if scale > 1:
+            level = self.image.resize(size, Image.NEAREST)
+        else:
+            source = min((s for s in self.levels if scale < s < 1), default=1)
+            level = self.get(source).resize(size, Image.LANCZOS)
+        self.levels[scale] = level
+        while len(self.levels) > Style.pin_cache_levels:
+            self.levels.popitem(last=False)
+        return level
+
+
+class PinBoard(object):
+    """
+    贴图进程：所有贴图作为同一进程中的Toplevel显示，图片保存在内存中不再从磁盘读取
+    第一个贴图的进程在本地端口监听，之后其它截图进程通过send_command把图片交给它显示
+    """
+
+    def __init__(self):
+        self.root = tk.Tk()
+        self.root.withdraw()
+        self.pins = {}                  # Toplevel -> [金字塔, 缩放级别序号, 当前显示的PhotoImage]
+        self.pyramids = {}              # 图片内容摘要 -> 金字塔，内容相同的贴图共享
+        self.inbox = queue.Queue()      # 监听线程收到的贴图，在主线程中创建窗口
+        self.commands = {'pin': self.pin_command}
+        self.server = None
+
+    @classmethod
+    def pin_image(cls, image, position=(0, 0)):
+        """
+        贴图：已有贴图进程时交给它显示并返回，否则当前进程成为贴图进程，直到所有贴图关闭
+        """
+        image = rgb_image(image)
+        if send_command('pin', image.tobytes(), size=image.size, position=position):
+            return
+        board = cls()
+        board.listen()
+        board.pin(image, position)
+        board.root.mainloop()
+        if board.server:
+            board.server.close()
+
+    def listen(self):
+        try:
+            self.server = socket.create_server(('127.0.0.1', Style.pin_port))
+        except OSError:     # 端口被占用，只显示本进程的贴图
+            logger.info('pin server not started, port %d in use', Style.pin_port)
+            return
+        create_thread(serve_commands, (self.server, self.commands))
+        self.root.after(100, self.poll)
+
+    def pin_command(self, header, payload):
+        """
+        监听线程中执行，只解码图片，窗口在主线程中创建
+        """
+        self.inbox.put((Image.frombytes('RGB', tuple(header['size']), payload), tuple(header['position'])))
+        return True
+
+    def poll(self):
+        while not self.inbox.empty():
+            self.pin(*self.inbox.get())
+        self.root.after(100, self.poll)
+
+    def pin(self, image, position=(0, 0)):
+        """
+        创建一个贴图窗口，左键拖动，滚轮缩放，右键关闭
+        """
+        key = image_digest(image)
+        if (pyramid := self.pyramids.get(key)) is None:
+            pyramid = self.pyramids[key] = ZoomPyramid(image, key)
+        top = tk.Toplevel(self.root)
+        top.geometry('+%d+%d' % tuple(map(int, position)))
+        label = tk.Label(top, bd=0)
+        label.pack()
+        self.pins[top] = [pyramid, Style.pin_zoom_values.index(1), None]
+        self.show(top)
+        drag = [0, 0]
+
+        def start_pos(event):
+            drag[0], drag[1] = event.x, event.y
+
+        def move(event):
+            top.geometry(f'+{event.x_root - drag[0]}+{event.y_root - drag[1]}')
+
+        def zoom(event):
+            step = 1 if event.num == 4 or event.delta > 0 else -1
+            self.zoom(top, step, event.x, event.y)
+
+        label.bind('<Button-1>', start_pos)
+        label.bind('<B1-Motion>', move)
+        label.bind('<Button-3>', lambda e: self.close(top))
+        label.bind('<MouseWheel>', zoom)
+        label.bind('<Button-4>', zoom)
+        label.bind('<Button-5>', zoom)
+        ScreenShot.set_headless(top, full=False)
+
+    def show(self, top):
+        pin = self.pins[top]
+        pin[2] = ImageTk.PhotoImage(pin[0].get(Style.pin_zoom_values[pin[1]]))
+        top.winfo_children()[0].configure(image=pin[2])
+
+    def zoom(self, top, step, x, y):
+        """
+        以鼠标位置为中心缩放贴图
+        """
+        pin = self.pins[top]
+        index = min(max(pin[1] + step, 0), len(Style.pin_zoom_values) - 1)
+        if index == pin[1]:
+            return
+        ratio = Style.pin_zoom_values[index] / Style.pin_zoom_values[pin[1]]
+        pin[1] = index
+        self.show(top)
+        top.geometry('+%d+%d' % (top.winfo_x() + x - x * ratio, top.winfo_y() + y - y * ratio))
+
+    def close(self, top):
+        pyramid = self.pins.pop(top)[0]
+        top.destroy()
+        if all(pin[0] is not pyramid for pin in self.pins.values()):
+            self.pyramids.pop(pyramid.key, None)
+        if not self.pins:
+            self.root.quit()
+
+
 class ScreenShot(object):
     """
     截屏工具实现类
     """
 
-    def __init__(self):
+    def __init__(self, profiler=None, screen_image=None, grab=None):
+        """
+        screen_image: 指定冻结的屏幕图片，不指定时截取鼠标所在的显示器，基准测试使用固定图片
+        grab: 截取最终选框区域的函数，参数为虚拟桌面坐标，默认为grab_screen
+        """
+        self.timings = {}                        # 启动各阶段的耗时（毫秒）
+        start_time = time.perf_counter()
         self.root = tk.Tk()
+        self.profiler = profiler
+        if profiler:
+            profiler.patch(self.root)
+        self.grab = grab or grab_screen
+        if screen_image is not None:
+            self.screen_x, self.screen_y = 0, 0
+            self.screen_width, self.screen_height = screen_image.size
+        else:
+            # 只截取鼠标所在的显示器，画布坐标加上显示器原点(screen_x, screen_y)即为虚拟桌面坐标
+            x1, y1, x2, y2 = monitor_at(list_monitors(self.root), *self.root.winfo_pointerxy())
+            self.screen_x, self.screen_y = x1, y1
+            self.screen_width, self.screen_height = x2 - x1, y2 - y1
+            # 初次截屏，创建主画布，并将截屏显示在主画布的image控件
+            st = time.perf_counter()
+            screen_image = self.grab((x1, y1, x2, y2))
+            self.timings['grab_ms'] = (time.perf_counter() - st) * 1000
+        self.screen_image = rgb_image(screen_image)
+        self.root.geometry(f'{self.screen_width}x{self.screen_height}+{self.screen_x}+{self.screen_y}')
         self.set_headless(self.root)
-        self.screen_width = self.root.winfo_screenwidth()
-        self.screen_height = self.root.winfo_screenheight()
-        if os.name == 'posix' and self.screen_width > 3000:
-            self.screen_width = self.screen_width // 2
-        # 初次截全屏，创建主画布，并将截屏显示在主画布的image控件
-        self.image = ImageTk.PhotoImage(ImageGrab.grab((0, 0, self.screen_width, self.screen_height)))
-        self.mask = ImageTk.PhotoImage(Image.new("RGBA", (self.screen_width, self.screen_height), (40, 40, 40, 120)))
+        self.screen_pixels = self.screen_image.load()   # 冻结截图的像素访问对象，放大镜取色使用
+        # 冻结截图分块以PPM数据写入PhotoImage，鼠标所在的块立即显示，其余的块在空闲时依次补全
+        self.image = tk.PhotoImage(width=self.screen_width, height=self.screen_height)
+        self.mask = None                         # 选框外的遮罩图片，分块显示完成后再创建
+        self.start_time = start_time
+        self.tiles = self.order_tiles(*self.root.winfo_pointerxy())
         self.canvas = tk.Canvas(self.root, width=self.screen_width, height=self.screen_height, cursor=Style.rect_cursor)
+        if profiler:
+            profiler.canvas = self.canvas
+            profiler.patch(self.canvas)
         self.canvas.create_image(0, 0, image=self.image, anchor='nw')
         self.canvas.pack(fill='both', expand=1)
+        self.paint_tile(self.tiles.popleft())
+        self.canvas.bind('<Expose>', self.first_paint_event)
+        self.root.after_idle(self.paint_tiles)
         self.canvas.bind('<Motion>', self.reference_line_event)           # 绑定鼠标移动事件，画开始截图辅助线
         self.canvas.bind('<Button-1>', self.rectangle_start_event)        # 绑定鼠标左键事件，启动截图
         self.canvas.bind('<Button-3>', self.cancel_process_event)         # 绑定鼠标右键事件，取消截图
         self.canvas.bind('<B1-Motion>', self.rectangle_move_event)        # 绑定鼠标按下拖动事件，画截图区域选框
         self.canvas.bind('<ButtonRelease-1>', self.rectangle_end_event)   # 绑定鼠标释放事件，结束截图区域
+        self.root.bind('<Control-r>', self.add_record_region_event)       # 保留当前选框，继续框选下一个录屏区域
         self.gif_record = GifRecorder(self.root)
+        self.long_capture = LongCapture(self.root)
+        self.detector = RegionDetector(self.screen_image)   # 截屏后立即在后台检测边缘和区域
+        self.history = ScreenHistory()
 
         self.rectangle_start_pos = [None] * 2    # 矩形选框的启动坐标位置 (x_start, y_start)
         self.rectangle_move_pos = [None] * 2     # 选框内按住鼠标左键时的坐标，用于计算并整体移动选框
         self.rectangle_instance = None           # 截图范围矩形选框的实例
         self.mask_instance = [None] * 4          # 矩形选框之外的灰色遮罩实例
         self.refer_line_instance = [None] * 2    # 截图X Y辅助线实例列表
+        self.loupe_instance = None               # 放大镜的画图实例列表
+        self.loupe_photo = None                  # 放大镜复用的图片，原地更新
+        self.hover_instance = None               # 鼠标悬停区域的高亮框实例
+        self.hover_region = None                 # 鼠标悬停的检测区域，单击即可选中
         self.adjust_dot_instance = [None] * 8    # 矩形选框各角各边画的圆点实例列表
         self.in_adjust_dot_id = None             # 0:左上  1:右上  2:左下  3:右下  4/5:上下  6/7:左右  8:选框内  None:选框外
+        self.adjust_pending = None               # 调整选框时尚未刷新到画布的选框坐标
+        self.adjust_after_id = None              # 调整选框合并刷新的定时任务
+        self.adjust_moved = False                # 本次按下鼠标后选框是否被调整过
+        self.adjust_origin = None                # 本次调整前的选框坐标，调整后过小时恢复
         self.tool_window = None                  # 工具栏窗口
         self.tool_master = None                  # 截屏界面工具栏窗口的master
         self.tool_gif_master = None              # gif录屏界面工具栏窗口的master
@@ -467,7 +2635,61 @@ class ScreenShot(object):
         self.mark_position = [None] * 2          # 当前标记实例的坐标位置
         self.mark_instance = None                # 标记的画图实例
         self.mark_widgets = []                   # 标记的画图列表，用于撤回操作
+        self.mark_index = MarkIndex()            # 已完成标记的空间索引，key为标记的首个画图实例
+        self.mark_items = {}                     # 标记key -> 标记的画图实例列表
+        self.hover_mark = None                   # 选择工具下鼠标悬停的标记key
+        self.record_regions = []                 # Ctrl+R保留的其它录屏区域(画布坐标)，与当前选框同时录制
+        self.selected_mark = None                # 选择工具正在拖动的标记key
         self.tool_window_pos = [None] * 2        # 工具栏手动移动前的坐标
+        self.shot_image = None                   # 最终截取的图片
+
+    def order_tiles(self, pointer_x, pointer_y):
+        """
+        冻结截图的分块，按与鼠标的距离排序，鼠标所在的块排在最前
+        """
+        size = Style.tile_size
+        x, y = pointer_x - self.screen_x, pointer_y - self.screen_y
+        tiles = [(tx, ty, min(tx + size, self.screen_width), min(ty + size, self.screen_height))
+                 for ty in range(0, self.screen_height, size) for tx in range(0, self.screen_width, size)]
+        tiles.sort(key=lambda t: (max(t[0] - x, 0, x - t[2]) ** 2 + max(t[1] - y, 0, y - t[3]) ** 2))
+        return deque(tiles)
+
+    def paint_tile(self, box):
+        """
+        以PPM数据写入一块截图，PPM由Tk直接解析，不经过逐像素转换
+        """
+        tile = self.screen_image.crop(box)
+        data = b'P6 %d %d 255 ' % tile.size + tile.tobytes()
+        self.image.tk.call(self.image.name, 'put', data, '-format', 'ppm', '-to', box[0], box[1])
+
+    def paint_tiles(self):
+        """
+        空闲时写入下一块截图，全部完成后创建遮罩
+        """
+        if not self.tiles:
+            return
+        self.paint_tile(self.tiles.popleft())
+        if self.tiles:
+            self.root.after_idle(self.paint_tiles)
+        else:
+            self.timings['all_tiles_ms'] = (time.perf_counter() - self.start_time) * 1000
+            self.get_mask()
+            logger.info('screen %dx%d: first paint %.0f ms, all tiles %.0f ms', self.screen_width, self.screen_height,
+                        self.timings.get('first_paint_ms', 0), self.timings['all_tiles_ms'])
+
+    def flush_tiles(self):
+        while self.tiles:
+            self.paint_tile(self.tiles.popleft())
+
+    def first_paint_event(self, event):
+        self.canvas.unbind('<Expose>')
+        self.timings['first_paint_ms'] = (time.perf_counter() - self.start_time) * 1000
+
+    def get_mask(self):
+        if self.mask is None:
+            self.mask = ImageTk.PhotoImage(
+                Image.new("RGBA", (self.screen_width, self.screen_height), (40, 40, 40, 120)))
+        return self.mask
 
     def hand_move_tool_window(self, widget):
         def start_pos(event):
@@ -494,6 +2716,7 @@ class ScreenShot(object):
         area_txt = f'{int(x_end) - int(x_start)}*{int(y_end) - int(y_start)}'
         if self.tool_window is not None:
             self.tool_window.geometry(f'{width}x{height}+{x}+{y}')
+            self.tool_window.deiconify()
             self.tool_window.attributes("-topmost", 1)
             self.tool_widgets[0][1].configure(text=area_txt)
             return
@@ -526,9 +2749,11 @@ class ScreenShot(object):
                 '✎': ('Pen', False, lambda c=4: self.prepare_mark_view(c)),
                 'T': ('Text', False, lambda c=5: self.prepare_mark_view(c)),
                 '▨': ('Mosaic', False, lambda c=6: self.prepare_mark_view(c)),
+                '↖': ('Select', False, lambda c=7: self.prepare_mark_view(c)),
                 '⟲': ('Revoke', True, self.undo_mark_event),
                 '✕': ('Exit', True, self.cancel_process_event),
                 '▣': ('Hang', True, self.float_show_screenshot_event),
+                '☰': ('History', True, self.show_history_event),
                 '✓': ('To Clipboard', True, self.start_set_clipboard_event)
             }.items():
                 btn = BaseButton(
@@ -597,10 +2822,25 @@ class ScreenShot(object):
                         f'{limit_time // 60:02}:{limit_time % 60:02}')
                 txt_label.configure(text=_txt)
 
+        def modify_estimate():
+            time.sleep(3)
+            while self.gif_record.is_recording:     # 录制结束后不再预估
+                estimate_label.configure(text=f'≈{format_size(self.gif_record.estimate_size())}')
+                time.sleep(3)
+
+        def choose_export_event(event=None):
+            self.gif_record.export_scale = int(scale_box.get().strip('%')) / 100
+            self.gif_record.export_fps = 0 if fps_box.get() == 'Auto' else int(fps_box.get().strip('fps'))
+            self.gif_record.export_colors = int(color_box.get().strip('c'))
+            self.gif_record.capture_scale = int(grab_box.get().split(':')[1])
+
         def modify_state():
             while 1:
                 if self.gif_record.is_recording:
                     save_btn.configure(text='SAVE', font=(Style.font, 9))
+                if self.gif_record.is_saving:
+                    for box in (scale_box, fps_box, color_box):
+                        box.configure(state='disabled')
                 if self.gif_record.is_asking:
                     exit_btn.configure(state='disabled')
                     save_btn.configure(text='Saving', font=(Style.font, 9), state='disabled')
@@ -608,6 +2848,10 @@ class ScreenShot(object):
                     exit_btn.configure(state='disabled')
                     save_btn.configure(text=f'{self.gif_record.progress}%', font=(Style.font, 9),
                                        state='disabled')
+                    if progress := self.gif_record.export_progress:     # 显示最慢的导出格式
+                        key = min(progress, key=progress.get)
+                        name = f'{key[1]} #{key[0] + 1}' if self.gif_record.regions else key[1]
+                        estimate_label.configure(text=f'{name} {progress[key]}%')
                 else:
                     exit_btn.configure(state='normal')
                     if not self.gif_record.is_recording:
@@ -620,6 +2864,7 @@ class ScreenShot(object):
                 create_thread(modify_state)
                 create_thread(modify_time)
                 create_thread(self.gif_record.start)
+                create_thread(modify_estimate)
 
             for _ in range(2):
                 if self.gif_record.is_prepare():
@@ -647,7 +2892,9 @@ class ScreenShot(object):
                 else:
                     gif_start()
 
-            self.gif_record.init((int(x_start), int(y_start), int(x_end), int(y_end)), mode=mode)
+            self.canvas.delete('record_region')
+            self.gif_record.init(self.screen_box(x_start, y_start, x_end, y_end), mode=mode,
+                                 regions=[self.screen_box(*coords) for coords in self.record_regions])
             create_thread(lambda: countdown(5))
             create_thread(self.gif_record.prepare)
 
@@ -657,6 +2904,7 @@ class ScreenShot(object):
                 self.gif_record.stop()
             else:
                 mode_box.configure(state='disabled')
+                grab_box.configure(state='disabled')
                 gif_init(mode_box.get())
 
         def cancel_gif_event(event=None):
@@ -664,6 +2912,7 @@ class ScreenShot(object):
             self.root.after(500, self.cancel_process_event)
 
         width, height = Style.tool_window_size['gif']
+        bar_height = 40
         self.tool_gif_master = tk.Frame(self.tool_window, bg=Style.tool_bg)
         self.tool_gif_master.place(x=0, y=0, width=width, height=height)
         label = tk.Label(self.tool_gif_master, text='⣿', font=(Style.font, 14),
@@ -671,22 +2920,106 @@ class ScreenShot(object):
         label.place(x=0, y=0, width=30, height=height)
         self.hand_move_tool_window(label)
         txt_label = tk.Label(self.tool_gif_master, text='', font=(Style.font, 10), bg=Style.tool_bg, fg='Gray70')
-        txt_label.place(x=40, y=5, width=90, height=height - 10)
+        txt_label.place(x=40, y=5, width=90, height=bar_height - 10)
         mode_list = list(self.gif_record.mode_info.keys())
         mode_box = ttk.Combobox(self.tool_gif_master, width=20, values=mode_list, font=(Style.font, 9), state='readonly')
         mode_box.set(mode_list[0])
-        mode_box.place(x=140, y=5, width=120, height=height - 10)
+        mode_box.place(x=140, y=5, width=120, height=bar_height - 10)
         mode_box.bind("<<ComboboxSelected>>", choose_mode_event)
         exit_btn = BaseButton(
             self.tool_gif_master, text='✕', font=(Style.font, 18), bg=Style.tool_bg, width=2, command=cancel_gif_event)
-        exit_btn.place(x=270, y=2, width=40, height=height - 6)
+        exit_btn.place(x=270, y=2, width=40, height=bar_height - 6)
         save_btn = BaseButton(
             self.tool_gif_master, text='▶', font=(Style.font, 14), bg=Style.tool_bg, width=4, command=start_stop_event)
-        save_btn.place(x=320, y=5, width=40, height=height - 10)
+        save_btn.place(x=320, y=5, width=40, height=bar_height - 10)
+        estimate_label = tk.Label(self.tool_gif_master, text='', font=(Style.font, 10), bg=Style.tool_bg, fg='Gray50')
+        estimate_label.place(x=365, y=5, width=85, height=bar_height - 10)
+        scale_box = ttk.Combobox(
+            self.tool_gif_master, width=5, values=Style.scale_values, font=(Style.font, 9), state='readonly')
+        scale_box.set(Style.scale_values[0])
+        scale_box.place(x=40, y=bar_height, width=90, height=height - bar_height - 6)
+        fps_box = ttk.Combobox(
+            self.tool_gif_master, width=5, values=Style.fps_values, font=(Style.font, 9), state='readonly')
+        fps_box.set(Style.fps_values[0])
+        fps_box.place(x=140, y=bar_height, width=120, height=height - bar_height - 6)
+        color_box = ttk.Combobox(
+            self.tool_gif_master, width=5, values=Style.color_values, font=(Style.font, 9), state='readonly')
+        color_box.set(Style.color_values[0])
+        color_box.place(x=270, y=bar_height, width=90, height=height - bar_height - 6)
+        grab_box = ttk.Combobox(
+            self.tool_gif_master, width=5, values=Style.grab_values, font=(Style.font, 9), state='readonly')
+        grab_box.set(Style.grab_values[0])
+        grab_box.place(x=370, y=bar_height, width=80, height=height - bar_height - 6)
+        for box in (scale_box, fps_box, color_box, grab_box):
+            box.bind("<<ComboboxSelected>>", choose_export_event)
         Tip.enter_tips(exit_btn, Style.get_language('Exit'))
         Tip.enter_tips(save_btn, Style.get_language('Start/Stop'))
+        Tip.enter_tips(estimate_label, Style.get_language('Estimated Size'))
+        Tip.enter_tips(scale_box, Style.get_language('Scale'))
+        Tip.enter_tips(fps_box, Style.get_language('Frame Rate'))
+        Tip.enter_tips(color_box, Style.get_language('Colors'))
+        Tip.enter_tips(grab_box, Style.get_language('Capture Scale'))
         choose_mode_event()
 
+    def pack_long_tool_window(self):
+        """
+        滚动长截图工具栏布局
+        """
+        auto_scroll = [True]
+
+        def switch_scroll_event():
+            auto_scroll[0] = not auto_scroll[0]
+            scroll_btn.configure(
+                text=Style.get_language('Auto Scroll') if auto_scroll[0] else Style.get_language('Manual Scroll'))
+            if auto_scroll[0]:
+                scroll_btn.up()
+
+        def modify_state():
+            while self.long_capture.is_capturing:
+                txt_label.configure(text=f'{self.long_capture.height}px')
+                time.sleep(0.3)
+
+        def capture():
+            self.long_capture.start(auto_scroll[0])
+            self.root.after(0, self.cancel_process_event)
+
+        def start_stop_event(event=None):
+            if self.long_capture.is_capturing:
+                self.long_capture.stop()
+                return
+            x_start, y_start, x_end, y_end = self.canvas.coords(self.rectangle_instance)
+            self.long_capture.init(self.screen_box(x_start, y_start, x_end, y_end))
+            self.long_capture.is_capturing = True
+            scroll_btn.configure(state='disabled')
+            start_btn.configure(text='■')
+            self.root.withdraw()
+            self.canvas.destroy()
+            self.root.update()
+            create_thread(modify_state)
+            self.root.after(300, lambda: create_thread(capture))
+
+        def cancel_long_event(event=None):
+            self.long_capture.cancel()
+            self.root.after(500, self.cancel_process_event)
+
+        width, height = Style.tool_window_size['long']
+        master = tk.Frame(self.tool_window, bg=Style.tool_bg)
+        master.place(x=0, y=0, width=width, height=height)
+        label = tk.Label(master, text='⣿', font=(Style.font, 14), bg=Style.tool_bg, fg='Gray70', anchor='e')
+        label.place(x=0, y=0, width=30, height=height)
+        self.hand_move_tool_window(label)
+        txt_label = tk.Label(master, text='0px', font=(Style.font, 10), bg=Style.tool_bg, fg='Gray70')
+        txt_label.place(x=40, y=5, width=80, height=height - 10)
+        scroll_btn = BaseButton(master, text=Style.get_language('Auto Scroll'), font=(Style.font, 9),
+                                bg=Style.tool_bg, up=False, command=switch_scroll_event)
+        scroll_btn.place(x=125, y=5, width=90, height=height - 10)
+        exit_btn = BaseButton(master, text='✕', font=(Style.font, 18), bg=Style.tool_bg, command=cancel_long_event)
+        exit_btn.place(x=225, y=2, width=40, height=height - 6)
+        start_btn = BaseButton(master, text='▶', font=(Style.font, 14), bg=Style.tool_bg, command=start_stop_event)
+        start_btn.place(x=270, y=5, width=40, height=height - 10)
+        Tip.enter_tips(exit_btn, Style.get_language('Exit'))
+        Tip.enter_tips(start_btn, Style.get_language('Start/Stop'))
+
     def pack_settings_window_event(self):
         """
         设置窗口布局
@@ -694,17 +3027,13 @@ class ScreenShot(object):
         def modify_settings():
             Style.theme_color = theme_box.get()
             Style.mask_switch = True if mask_box.get() == 'YES' else False
+            Style.loupe_switch = True if loupe_box.get() == 'YES' else False
+            Style.snap_switch = True if snap_box.get() == 'YES' else False
+            Style.edit_switch = True if edit_box.get() == 'YES' else False
             Style.choose_pt = pt_box.get()
             Style.choose_pi = pi_box.get()
             Style.choose_lang = lang_box.get()
-            Style.write_settings({
-                'theme_color': Style.theme_color,
-                'mask_switch': Style.mask_switch,
-                'tips_switch': Style.tips_switch,
-                'default_pt': Style.choose_pt,
-                'default_pi': Style.choose_pi,
-                'language': Style.choose_lang
-            })
+            Style.write_settings(Style.dump_settings())
             self.tool_set_master.place_forget()
 
         def change_tips_switch(click=True):
@@ -733,6 +3062,12 @@ class ScreenShot(object):
         pi_box.place(x=110, y=widget_height + 10, width=80, height=widget_height)
         lang_box = ttk.Combobox(self.tool_set_master, width=4, values=Style.languages, state='readonly')
         lang_box.place(x=210, y=5, width=80, height=widget_height)
+        loupe_box = ttk.Combobox(self.tool_set_master, width=4, values=('YES', 'NO'), state='readonly')
+        loupe_box.place(x=210, y=widget_height + 10, width=80, height=widget_height)
+        snap_box = ttk.Combobox(self.tool_set_master, width=4, values=('YES', 'NO'), state='readonly')
+        snap_box.place(x=310, y=5, width=80, height=widget_height)
+        edit_box = ttk.Combobox(self.tool_set_master, width=4, values=('YES', 'NO'), state='readonly')
+        edit_box.place(x=310, y=widget_height + 10, width=80, height=widget_height)
         tips_switch = BaseButton(self.tool_set_master, text='', width=11, up=False, command=change_tips_switch)
         tips_switch.place(x=450, y=5, width=120, height=widget_height)
         change_tips_switch(click=False)
@@ -743,19 +3078,25 @@ class ScreenShot(object):
         pt_box.set(Style.choose_pt)
         pi_box.set(Style.choose_pi)
         lang_box.set(Style.choose_lang)
+        loupe_box.set('YES' if Style.loupe_switch else 'NO')
+        snap_box.set('YES' if Style.snap_switch else 'NO')
+        edit_box.set('YES' if Style.edit_switch else 'NO')
         Tip.enter_tips(theme_box, Style.get_language('Theme'))
         Tip.enter_tips(mask_box, Style.get_language('Outer Mask'))
         Tip.enter_tips(pt_box, Style.get_language('Font Size'))
         Tip.enter_tips(pi_box, Style.get_language('Line Thickness'))
         Tip.enter_tips(lang_box, Style.get_language('Language'))
+        Tip.enter_tips(loupe_box, Style.get_language('Loupe'))
+        Tip.enter_tips(snap_box, Style.get_language('Snap'))
+        Tip.enter_tips(edit_box, Style.get_language('Edit Frames'))
 
     def choose_screenshot_type_event(self, event):
         """
         选择截屏/录屏类型回调
         """
         index = Style.shot_types.index(self.tool_widgets[0][0].get())
-        if index == 1:  # 录制gif
-            x, y, width, height = self.calc_tool_window_position('gif')
+        if index in (1, 2):  # 录制gif / 滚动长截图
+            x, y, width, height = self.calc_tool_window_position(('pic', 'gif', 'long')[index])
             self.tool_window.geometry(f'{width}x{height}+{x}+{y}')
             self.tool_master.place_forget()
             self.delete_adjust_dots()
@@ -766,7 +3107,10 @@ class ScreenShot(object):
             self.canvas.unbind('<ButtonRelease-1>')
             self.canvas.unbind('<Double-Button-1>')
             self.canvas.configure(cursor=Style.default_cursor)
-            self.pack_gif_tool_window()
+            if index == 1:
+                self.pack_gif_tool_window()
+            else:
+                self.pack_long_tool_window()
 
     def show_tip(self, text):
         """
@@ -807,6 +3151,8 @@ class ScreenShot(object):
         """
         取消截图
         """
+        if self.profiler:
+            self.profiler.dump()
         self.canvas.destroy()
         self.root.quit()
         self.root.destroy()
@@ -827,10 +3173,17 @@ class ScreenShot(object):
                     y = y_start - gap - height
                 else:
                     y = self.screen_height - height  # 顶部也放不下，那就底部挤着
+            x, y = x + self.screen_x, y + self.screen_y
         else:
             x, y = self.tool_window.geometry().replace('x', '+').split('+')[2:]
         return int(x), int(y), width, height
 
+    def screen_box(self, x1, y1, x2, y2):
+        """
+        画布坐标转换为虚拟桌面坐标
+        """
+        return int(x1) + self.screen_x, int(y1) + self.screen_y, int(x2) + self.screen_x, int(y2) + self.screen_y
+
     def check_in_widget(self, x, y, widget=None):
         """
         判断坐标是否在控件(canvas子控件)内部，控件为None时，判断是否在整个屏幕内
@@ -853,6 +3206,82 @@ class ScreenShot(object):
         else:
             self.canvas.coords(self.refer_line_instance[0], pos1)
             self.canvas.coords(self.refer_line_instance[1], pos2)
+        self.show_hover_region(event.x, event.y)
+        self.show_loupe(event.x, event.y)
+
+    def show_hover_region(self, x, y):
+        """
+        高亮鼠标所在的检测区域
+        """
+        region = self.detector.region_at(x, y) if Style.snap_switch else None
+        if region == self.hover_region:
+            return
+        self.hover_region = region
+        if region is None:
+            self.delete_hover_region()
+        elif self.hover_instance is None:
+            self.hover_instance = self.canvas.create_rectangle(region, outline=Style.theme_color, width=2, dash=(6, 4))
+        else:
+            self.canvas.coords(self.hover_instance, region)
+
+    def delete_hover_region(self):
+        """
+        删除悬停区域的高亮框
+        """
+        if self.hover_instance is not None:
+            self.canvas.delete(self.hover_instance)
+            self.hover_instance = None
+
+    def snap_point(self, x, y):
+        """
+        坐标吸附到附近的界面边缘
+        """
+        if not Style.snap_switch:
+            return x, y
+        return self.detector.snap_x(x, y), self.detector.snap_y(x, y)
+
+    def show_loupe(self, x, y):
+        """
+        放大镜：在鼠标旁放大显示冻结截图，并显示当前像素的RGB和十六进制颜色
+        复用同一个PhotoImage原地更新，每次事件只裁剪放大一小块区域
+        """
+        if not Style.loupe_switch:
+            return
+        x, y = int(x), int(y)
+        r, zoom = Style.loupe_radius, Style.loupe_zoom
+        size, text_height = (2 * r + 1) * zoom, 36
+        if self.loupe_instance is None:
+            self.loupe_photo = ImageTk.PhotoImage('RGB', (size, size))
+            self.loupe_instance = [
+                self.canvas.create_image(0, 0, image=self.loupe_photo, anchor='nw', tags='loupe'),
+                self.canvas.create_rectangle(0, 0, 0, 0, outline=Style.theme_color, width=2, tags='loupe'),
+                self.canvas.create_rectangle(0, 0, 0, 0, outline=Style.lines_color, tags='loupe'),
+                self.canvas.create_rectangle(0, 0, 0, 0, fill='Gray20', outline='', tags='loupe'),
+                self.canvas.create_text(0, 0, text='', font=(Style.font, 9), fill='Snow', anchor='nw', tags='loupe')
+            ]
+        self.loupe_photo.paste(self.screen_image.crop((x - r, y - r, x + r + 1, y + r + 1)).resize(
+            (size, size), Image.NEAREST))
+        # 默认显示在鼠标右下方，超出屏幕时翻到另一侧
+        lx = x + 20 if x + 20 + size < self.screen_width else x - 20 - size
+        ly = y + 20 if y + 20 + size + text_height < self.screen_height else y - 20 - size - text_height
+        image, border, center, text_bg, text = self.loupe_instance
+        self.canvas.coords(image, lx, ly)
+        self.canvas.coords(border, lx, ly, lx + size, ly + size)
+        self.canvas.coords(center, lx + r * zoom, ly + r * zoom, lx + (r + 1) * zoom, ly + (r + 1) * zoom)
+        self.canvas.coords(text_bg, lx, ly + size, lx + size, ly + size + text_height)
+        self.canvas.coords(text, lx + 4, ly + size + 3)
+        if 0 <= x < self.screen_image.width and 0 <= y < self.screen_image.height:
+            rgb = self.screen_pixels[x, y][:3]
+            self.canvas.itemconfig(text, text='%d, %d\nRGB%s #%02X%02X%02X' % (x, y, rgb, *rgb))
+        self.canvas.tag_raise('loupe')
+
+    def delete_loupe(self):
+        """
+        删除放大镜
+        """
+        if self.loupe_instance is not None:
+            self.canvas.delete('loupe')
+            self.loupe_instance = None
 
     def delete_reference_lines(self):
         """
@@ -884,8 +3313,11 @@ class ScreenShot(object):
         """
         点击鼠标左键，记录截图开始位置
         """
-        self.rectangle_start_pos[0] = event.x
-        self.rectangle_start_pos[1] = event.y
+        x, y = event.x, event.y
+        if self.adjust_dot_instance[0] is None:     # 首次选框时吸附边缘
+            x, y = self.snap_point(x, y)
+        self.rectangle_start_pos[0] = x
+        self.rectangle_start_pos[1] = y
 
     def rectangle_move_event(self, event):
         """
@@ -893,43 +3325,92 @@ class ScreenShot(object):
         """
         if self.rectangle_start_pos[0] is None:
             return
-        coords = *self.rectangle_start_pos, event.x, event.y
+        x, y = event.x, event.y
+        if self.adjust_dot_instance[0] is None:     # 首次选框时吸附边缘，不再高亮悬停区域
+            x, y = self.snap_point(x, y)
+            self.hover_region = None
+            self.delete_hover_region()
+        coords = *self.rectangle_start_pos, x, y
         if self.rectangle_instance is None:
             self.rectangle_instance = self.canvas.create_rectangle(coords, **Style.rectangle_style)
         else:
             self.canvas.coords(self.rectangle_instance, coords)
+        if self.adjust_dot_instance[0] is None:    # 首次选框时显示放大镜，调整选框时不显示
+            self.show_loupe(event.x, event.y)
         if not Style.mask_switch:
             return
         # 画遮罩
         x_start, y_start, x_end, y_end = self.canvas.coords(self.rectangle_instance)
         w, h = self.screen_width, self.screen_height
         if self.mask_instance[0] is None:
-            self.mask_instance[0] = self.canvas.create_image(0, 0, image=self.mask, anchor='nw')
-            self.mask_instance[1] = self.canvas.create_image(0, 0, image=self.mask, anchor='nw')
-            self.mask_instance[2] = self.canvas.create_image(0, 0, image=self.mask, anchor='nw')
-            self.mask_instance[3] = self.canvas.create_image(0, 0, image=self.mask, anchor='nw')
+            mask = self.get_mask()
+            self.mask_instance[0] = self.canvas.create_image(0, 0, image=mask, anchor='nw')
+            self.mask_instance[1] = self.canvas.create_image(0, 0, image=mask, anchor='nw')
+            self.mask_instance[2] = self.canvas.create_image(0, 0, image=mask, anchor='nw')
+            self.mask_instance[3] = self.canvas.create_image(0, 0, image=mask, anchor='nw')
         self.canvas.moveto(self.mask_instance[0], x_end - w, y_start - h)
         self.canvas.moveto(self.mask_instance[1], x_end, y_end - h)
         self.canvas.moveto(self.mask_instance[2], x_start, y_end)
         self.canvas.moveto(self.mask_instance[3], x_start - w, y_start)
         self.canvas.tag_raise(self.rectangle_instance)
+        self.canvas.tag_raise('loupe')
 
     def rectangle_end_event(self, event=None):
         """
-        鼠标左键释放，结束截图选框
+        鼠标左键释放，结束截图选框，未拖动时选中鼠标悬停的检测区域
         """
+        if self.rectangle_instance is None and self.hover_region is not None:
+            x_start, y_start, x_end, y_end = self.hover_region
+            self.rectangle_start_pos[0] = x_start
+            self.rectangle_start_pos[1] = y_start
+            self.rectangle_move_event(Event(x_end, y_end))
         if self.rectangle_instance is None:
             return
         x_start, y_start, x_end, y_end = self.canvas.coords(self.rectangle_instance)
         if x_end - x_start < Style.rectangle_limit and y_end - y_start < Style.rectangle_limit:
             self.show_tip(Style.get_language('Too small range'))
             return
-        self.canvas.unbind('<ButtonRelease-1>')
         self.canvas.bind('<Motion>', self.change_cursor_in_range_event)
         self.canvas.bind('<Button-1>', self.move_rectangle_start_event)
         self.canvas.bind('<B1-Motion>', self.adjust_rectangle_event)
+        self.canvas.bind('<ButtonRelease-1>', self.adjust_rectangle_end_event)
         self.canvas.bind('<Double-Button-1>', self.start_set_clipboard_event)
         self.delete_reference_lines()
+        self.delete_loupe()
+        self.delete_hover_region()
+        self.update_adjust_dots()
+        self.pack_pic_tool_window()
+
+    def add_record_region_event(self, event=None):
+        """
+        Ctrl+R: 保留当前选框作为录屏区域，画虚线框标出，然后重新框选下一个区域
+        切换到录制gif后，所有保留的区域和当前选框按一次抓屏同时录制
+        """
+        if self.rectangle_instance is None or self.adjust_dot_instance[0] is None:
+            return      # 只在调整选框阶段可用，进入标记后不再改变选框
+        coords = self.canvas.coords(self.rectangle_instance)
+        self.record_regions.append(coords)
+        self.canvas.create_rectangle(coords, outline=Style.theme_color, width=2, dash=(6, 4), tags='record_region')
+        self.delete_mask_instance()
+        self.mask_instance = [None] * 4
+        self.delete_adjust_dots()
+        self.canvas.delete(self.rectangle_instance)
+        self.rectangle_instance = None
+        self.rectangle_start_pos = [None] * 2
+        self.tool_window.withdraw()
+        self.canvas.unbind('<Double-Button-1>')
+        self.canvas.bind('<Motion>', self.reference_line_event)
+        self.canvas.bind('<Button-1>', self.rectangle_start_event)
+        self.canvas.bind('<B1-Motion>', self.rectangle_move_event)
+        self.canvas.bind('<ButtonRelease-1>', self.rectangle_end_event)
+        self.canvas.configure(cursor=Style.rect_cursor)
+        self.show_tip(Style.get_language('Region kept'))
+
+    def update_adjust_dots(self):
+        """
+        按选框当前坐标画出或移动8个调整圆点
+        """
+        x_start, y_start, x_end, y_end = self.canvas.coords(self.rectangle_instance)
         offset = Style.dot_offset
         left_top_coords = x_start - offset, y_start - offset, x_start + offset, y_start + offset
         right_top_coords = x_end - offset, y_start - offset, x_end + offset, y_start + offset
@@ -962,12 +3443,12 @@ class ScreenShot(object):
             self.canvas.coords(self.adjust_dot_instance[6], top_center_coords)
             self.canvas.coords(self.adjust_dot_instance[7], bottom_canter_coords)
 
-        self.pack_pic_tool_window()
-
     def move_rectangle_start_event(self, event):
         """
         记录矩形选框开始移动时的鼠标坐标，用于后续计算移动的距离
         """
+        self.adjust_moved = False
+        self.adjust_origin = tuple(self.canvas.coords(self.rectangle_instance))
         if self.in_adjust_dot_id != 8:
             return
         self.rectangle_move_pos[0] = event.x
@@ -975,7 +3456,7 @@ class ScreenShot(object):
 
     def adjust_rectangle_event(self, event):
         """
-        调整矩形选框的边界
+        调整矩形选框的边界，拖动中只记录坐标，按显示帧率合并刷新
         0___6___1
         |       |
         4       5
@@ -985,7 +3466,9 @@ class ScreenShot(object):
         if self.in_adjust_dot_id is None:
             return
         x_end, y_end = event.x, event.y
-        coords = self.canvas.coords(self.rectangle_instance)
+        if self.in_adjust_dot_id != 8:
+            x_end, y_end = self.snap_point(x_end, y_end)
+        coords = self.adjust_pending or self.canvas.coords(self.rectangle_instance)
         if self.in_adjust_dot_id == 0:
             x_start, y_start = coords[2], coords[3]
         elif self.in_adjust_dot_id == 1:
@@ -1020,9 +3503,42 @@ class ScreenShot(object):
             return
         self.rectangle_move_pos[0] = event.x
         self.rectangle_move_pos[1] = event.y
+        self.adjust_pending = (min(x_start, x_end), min(y_start, y_end), max(x_start, x_end), max(y_start, y_end))
+        self.adjust_moved = True
+        if self.adjust_after_id is None:
+            self.adjust_after_id = self.canvas.after(Style.adjust_interval, self.flush_adjust_rectangle)
+
+    def flush_adjust_rectangle(self):
+        """
+        把合并后的选框坐标刷新到画布，只移动选框、遮罩和调整圆点，不重建工具栏
+        """
+        self.adjust_after_id = None
+        if self.adjust_pending is None:
+            return
+        x_start, y_start, x_end, y_end = self.adjust_pending
+        self.adjust_pending = None
         self.rectangle_start_event(Event(x_start, y_start))
         self.rectangle_move_event(Event(x_end, y_end))
-        self.rectangle_end_event()
+        self.update_adjust_dots()
+
+    def adjust_rectangle_end_event(self, event=None):
+        """
+        调整选框结束，刷新剩余坐标后只重新定位一次工具栏
+        与首次选框相同，调整后的选框过小时提示，并恢复为调整前的选框
+        """
+        if self.adjust_after_id is not None:
+            self.canvas.after_cancel(self.adjust_after_id)
+            self.adjust_after_id = None
+        self.flush_adjust_rectangle()
+        if not self.adjust_moved:
+            return
+        self.adjust_moved = False
+        x_start, y_start, x_end, y_end = self.canvas.coords(self.rectangle_instance)
+        if x_end - x_start < Style.rectangle_limit and y_end - y_start < Style.rectangle_limit:
+            self.show_tip(Style.get_language('Too small range'))
+            self.adjust_pending = self.adjust_origin
+            self.flush_adjust_rectangle()
+        self.pack_pic_tool_window()
 
     def change_cursor_in_range_event(self, event):
         """
@@ -1062,8 +3578,14 @@ class ScreenShot(object):
             self.canvas.bind('<Button-1>', self.mark_create_event)
             self.canvas.bind('<B1-Motion>', self.mark_move_event)
             self.canvas.bind('<ButtonRelease-1>', self.mark_end_event)
-            self.canvas.bind('<Motion>', lambda event: self.tool_window.attributes("-topmost", 1))
-        self.canvas.configure(cursor=Style.rect_cursor)
+            self.canvas.bind('<Motion>', self.mark_hover_event)
+        self.set_hover_mark(None)
+        if index == 7:      # 选择标记
+            self.root.bind('<Delete>', self.delete_mark_event)
+            self.canvas.configure(cursor=Style.default_cursor)
+        else:
+            self.root.unbind('<Delete>')
+            self.canvas.configure(cursor=Style.rect_cursor)
 
     def mark_text_done(self):
         """
@@ -1074,6 +3596,7 @@ class ScreenShot(object):
             text_inst.stop()
             if text_inst.get():
                 self.mark_widgets.append(text_text)
+                self.index_mark(text_text)
             else:
                 self.canvas.delete(text_text)
             self.canvas.delete(text_rect)
@@ -1117,6 +3640,11 @@ class ScreenShot(object):
         """
         记录开始创建标记的起点坐标
         """
+        if self.tool_mark_type == 7:
+            self.selected_mark = self.hit_mark(event.x, event.y)
+            self.set_hover_mark(self.selected_mark)
+            self.mark_position[0], self.mark_position[1] = event.x, event.y
+            return
         if self.tool_mark_type == 4:
             self.mark_instance = []
         elif self.tool_mark_type == 5:
@@ -1135,6 +3663,14 @@ class ScreenShot(object):
         """
         创建标记拖动鼠标
         """
+        if self.tool_mark_type == 7:
+            if self.selected_mark is not None:
+                dx, dy = event.x - self.mark_position[0], event.y - self.mark_position[1]
+                for item in self.mark_items[self.selected_mark]:
+                    self.canvas.move(item, dx, dy)
+                self.canvas.move('mark_hover', dx, dy)
+                self.mark_position[0], self.mark_position[1] = event.x, event.y
+            return
         if self.tool_mark_type == 5 or self.mark_position[0] is None:
             return
         pi = Style.get_pi() // 2
@@ -1148,12 +3684,81 @@ class ScreenShot(object):
         """
         标记结束，记录标记的实例
         """
+        if self.tool_mark_type == 7:
+            if self.selected_mark is not None:     # 移动结束后更新索引
+                self.mark_index.move(self.selected_mark, self.canvas.bbox(*self.mark_items[self.selected_mark]))
+                self.selected_mark = None
+            return
         if self.tool_mark_type == 5 or self.mark_position[0] is None:
             return
         if self.mark_instance:
             self.mark_widgets.append(self.mark_instance)
+            self.index_mark(self.mark_instance)
             self.mark_instance = None
 
+    def index_mark(self, widget):
+        """
+        把完成的标记加入空间索引
+        """
+        items = widget if isinstance(widget, list) else [widget]
+        self.mark_items[items[0]] = items
+        self.mark_index.add(items[0], self.canvas.bbox(*items))
+
+    def unindex_mark(self, widget):
+        key = widget[0] if isinstance(widget, list) else widget
+        self.mark_index.remove(key)
+        self.mark_items.pop(key, None)
+        if key == self.hover_mark:
+            self.set_hover_mark(None)
+
+    def hit_mark(self, x, y):
+        """
+        查找坐标处最上层的标记：先用空间索引找出外接矩形包含该点的标记，线条再精确计算到线段的距离
+        return: 标记key，没有时为None
+        """
+        tolerance = Style.select_tolerance
+        for key in self.mark_index.query(x, y, tolerance):
+            for item in self.mark_items[key]:
+                if self.canvas.type(item) != 'line':
+                    return key      # 矩形、椭圆、马赛克、文本按外接矩形选中
+                coords = self.canvas.coords(item)
+                width = float(self.canvas.itemcget(item, 'width')) / 2 + tolerance
+                for i in range(0, len(coords) - 2, 2):
+                    if segment_distance(x, y, *coords[i: i + 4]) <= width:
+                        return key
+        return None
+
+    def set_hover_mark(self, key):
+        """
+        高亮鼠标悬停的标记
+        """
+        if key == self.hover_mark:
+            return
+        self.hover_mark = key
+        self.canvas.delete('mark_hover')
+        if key is not None:
+            x1, y1, x2, y2 = self.mark_index.boxes[key]
+            self.canvas.create_rectangle(x1 - 3, y1 - 3, x2 + 3, y2 + 3, outline=Style.theme_color, dash=(4, 2),
+                                         tags='mark_hover')
+
+    def mark_hover_event(self, event):
+        self.tool_window.attributes("-topmost", 1)
+        if self.tool_mark_type == 7 and self.selected_mark is None:
+            self.set_hover_mark(self.hit_mark(event.x, event.y))
+
+    def delete_mark_event(self, event=None):
+        """
+        删除鼠标悬停的标记
+        """
+        key = self.hover_mark
+        if key is None:
+            return
+        items = self.mark_items[key]
+        self.unindex_mark(key)
+        for item in items:
+            self.canvas.delete(item)
+        self.mark_widgets = [w for w in self.mark_widgets if (w[0] if isinstance(w, list) else w) != key]
+
     def undo_mark_event(self):
         """
         撤销上一次的标记
@@ -1161,6 +3766,7 @@ class ScreenShot(object):
         if not self.mark_widgets:
             return
         latest_widget = self.mark_widgets.pop(-1)
+        self.unindex_mark(latest_widget)
         if isinstance(latest_widget, list):
             for widget in latest_widget:
                 self.canvas.delete(widget)
@@ -1180,18 +3786,22 @@ class ScreenShot(object):
         Style.choose_color = color
 
     def set_clipboard_and_save(self):
+        self.flush_tiles()      # 最终截图截取的是屏幕上的冻结截图，需先显示完整
         x_start, y_start, x_end, y_end = self.canvas.coords(self.rectangle_instance)
         self.mark_text_done()
+        self.set_hover_mark(None)
         self.delete_mask_instance()
         self.delete_adjust_dots()
         self.canvas.delete(self.rectangle_instance)
+        self.canvas.delete('record_region')
         self.tool_window.destroy()
         self.root.update()
         time.sleep(0.2)
-        os.makedirs('img', exist_ok=True)
-        img_file = 'img/%s.png' % time.strftime('%Y%m%d%H%M%S', time.localtime())
-        image = ImageGrab.grab((x_start + 1, y_start + 1, x_end, y_end))
-        image.save(img_file)
+        box = self.screen_box(x_start + 1, y_start + 1, x_end, y_end)
+        self.shot_image = self.grab(box)
+        Style.last_region = list(box)
+        Style.write_settings(Style.dump_settings())
+        img_file = self.history.add(self.shot_image, box)
         set_clipboard_image(img_file)
         return img_file
 
@@ -1207,48 +3817,180 @@ class ScreenShot(object):
         另存为截图文件
         """
         init_name = '%s.png' % time.strftime('%Y%m%d%H%M%S', time.localtime())
-        if file_name := filedialog.asksaveasfilename(filetypes=[('Save Image file', '*.png')], initialfile=init_name):
-            shutil.move(self.set_clipboard_and_save(), file_name)
+        if file_name := filedialog.asksaveasfilename(
+                filetypes=[('Save Image file', '*.png'), ('Save WebP file', '*.webp')], initialfile=init_name):
+            img_file = self.set_clipboard_and_save()
+            if os.path.splitext(img_file)[1] == os.path.splitext(file_name)[1].lower():
+                shutil.copyfile(img_file, file_name)
+            else:
+                save_image(self.shot_image, file_name)
         self.cancel_process_event()
 
-    def float_show_screenshot_event(self):
+    def show_history_event(self):
         """
-        悬浮显示截图
-        """
-        _s_m_x = tk.IntVar()  # 鼠标开始x位置 #
-        _s_m_y = tk.IntVar()  # 鼠标开始y位置 #
-        _s_r_x = tk.IntVar()  # 窗体开始x位置 #
-        _s_r_y = tk.IntVar()  # 窗体开始y位置 #
-        _e_m_x = tk.IntVar()  # 鼠标结束x位置 #
-        _e_m_y = tk.IntVar()  # 鼠标结束y位置 #
-
-        def _start_pos(event):
-            _s_m_x.set(event.x_root)
-            _s_m_y.set(event.y_root)
-            _s_r_x.set(top.winfo_x())
-            _s_r_y.set(top.winfo_y())
-
-        def _end_pos(event):
-            _e_m_x.set(event.x_root)
-            _e_m_y.set(event.y_root)
-            new_x = _e_m_x.get() - _s_m_x.get() + _s_r_x.get()
-            new_y = _e_m_y.get() - _s_m_y.get() + _s_r_y.get()
-            top.geometry('+{}+{}'.format(new_x, new_y))
-
-        def _destroy(event):
+        历史截图浏览窗口，分页显示，缩略图在空闲时逐个加载，保证大量历史也能立即打开
+        左键: 复制到剪切板并退出  右键: 关闭窗口
+        """
+        cols, rows = 5, 4
+        thumb_w, thumb_h = ScreenHistory.thumb_size
+        page = [0]
+        photos = []
+
+        def show_page(offset=0):
+            page[0] = max(page[0] + offset, 0)
+            records, total = self.history.latest(page[0] * cols * rows, cols * rows)
+            pages = max(1, (total + cols * rows - 1) // (cols * rows))
+            if page[0] >= pages:
+                page[0] = pages - 1
+                records, total = self.history.latest(page[0] * cols * rows, cols * rows)
+            canvas.delete('all')
+            photos.clear()
+            page_label.configure(text=f'{page[0] + 1}/{pages}  ({total})')
+            for i, record in enumerate(records):
+                x, y = i % cols * (thumb_w + 10) + 5, i // cols * (thumb_h + 30) + 5
+                canvas.create_rectangle(x, y, x + thumb_w, y + thumb_h, outline='Gray70')
+                canvas.create_text(x, y + thumb_h + 3, anchor='nw', font=(Style.font, 9), fill='Gray40',
+                                   text=time.strftime('%m-%d %H:%M', time.localtime(record['time'])) +
+                                   '  %d*%d' % tuple(record['size']))
+                canvas.after_idle(load_thumb, page[0], record, x, y)
+
+        def load_thumb(index, record, x, y):
+            if index != page[0] or not canvas.winfo_exists():
+                return
+            try:
+                photo = ImageTk.PhotoImage(self.history.thumbnail(record))
+            except OSError:
+                return
+            photos.append(photo)
+            item = canvas.create_image(x + thumb_w // 2, y + thumb_h // 2, image=photo, anchor='center')
+            canvas.tag_bind(item, '<Button-1>', lambda event, r=record: choose(r))
+            canvas.tag_bind(item, '<Enter>', lambda event: canvas.configure(cursor=Style.hand_cursor))
+            canvas.tag_bind(item, '<Leave>', lambda event: canvas.configure(cursor=Style.default_cursor))
+
+        def choose(record):
+            set_clipboard_image(self.history.file(record))
             top.destroy()
+            self.cancel_process_event()
 
-        img_file = self.set_clipboard_and_save()
-        self.cancel_process_event()
-        top = tk.Tk()
-        self.float_img = ImageTk.PhotoImage(Image.open(img_file))
-        tk.Label(top, image=self.float_img).pack()
-        top.bind('<Button-1>', _start_pos)
-        top.bind('<B1-Motion>', _end_pos)
-        top.bind('<ButtonRelease-1>', _end_pos)
-        top.bind('<Button-3>', _destroy)
+        width, height = cols * (thumb_w + 10), rows * (thumb_h + 30) + 40
+        top = tk.Toplevel(self.root, bg=Style.tool_bg)
+        x, y = self.screen_x + (self.screen_width - width) // 2, self.screen_y + (self.screen_height - height) // 2
+        top.geometry(f'{width}x{height}+{x}+{y}')
         self.set_headless(top, full=False)
-        top.mainloop()
+        canvas = tk.Canvas(top, bg=Style.tool_bg, highlightthickness=0)
+        if self.profiler:
+            self.profiler.patch(canvas)
+        canvas.place(x=0, y=0, width=width, height=height - 40)
+        canvas.bind('<Button-3>', lambda event: top.destroy())
+        BaseButton(top, text='◀', font=(Style.font, 14), bg=Style.tool_bg,
+                   command=lambda: show_page(-1)).place(x=10, y=height - 35, width=40, height=30)
+        page_label = tk.Label(top, text='', font=(Style.font, 10), bg=Style.tool_bg, fg='Gray50')
+        page_label.place(x=60, y=height - 35, width=width - 170, height=30)
+        BaseButton(top, text='▶', font=(Style.font, 14), bg=Style.tool_bg,
+                   command=lambda: show_page(1)).place(x=width - 100, y=height - 35, width=40, height=30)
+        BaseButton(top, text='✕', font=(Style.font, 14), bg=Style.tool_bg,
+                   command=top.destroy).place(x=width - 50, y=height - 35, width=40, height=30)
+        show_page()
+
+    def float_show_screenshot_event(self):
+        """
+        悬浮显示截图，所有贴图由同一个贴图进程显示
+        """
+        x_start, y_start = self.canvas.coords(self.rectangle_instance)[:2]
+        self.set_clipboard_and_save()
+        self.cancel_process_event()
+        PinBoard.pin_image(self.shot_image, self.screen_box(x_start + 1, y_start + 1, 0, 0)[:2])
+
+
+class EventReplay(object):
+    """
+    基准测试的事件回放：用event_generate向截图界面注入鼠标键盘事件，每个事件后处理完界面刷新
+    """
+
+    def __init__(self, shot):
+        self.shot = shot
+        self.count = 0
+
+    def event(self, widget, sequence, **kwargs):
+        widget.event_generate(sequence, **kwargs)
+        self.shot.root.update()
+        self.count += 1
+
+    def move(self, x, y):
+        self.event(self.shot.canvas, '<Motion>', x=x, y=y)
+
+    def drag(self, x1, y1, x2, y2, steps=30):
+        """
+        从(x1, y1)按住左键拖动到(x2, y2)
+        """
+        canvas = self.shot.canvas
+        self.move(x1, y1)
+        self.event(canvas, '<ButtonPress-1>', x=x1, y=y1)
+        for i in range(1, steps + 1):
+            self.event(canvas, '<B1-Motion>', x=x1 + (x2 - x1) * i // steps, y=y1 + (y2 - y1) * i // steps)
+        self.event(canvas, '<ButtonRelease-1>', x=x2, y=y2)
+
+    def click(self, widget, x=1, y=1):
+        self.event(widget, '<ButtonPress-1>', x=x, y=y)
+        self.event(widget, '<ButtonRelease-1>', x=x, y=y)
+
+    def tool(self, index):
+        """
+        点击截图工具栏第二组按钮：0-6为标记类型，7选择标记，8撤销，12保存到剪切板
+        """
+        self.click(self.shot.tool_widgets[1][index])
+
+    def type(self, text):
+        self.shot.root.focus_force()
+        for char in text:
+            self.event(self.shot.root, '<KeyPress>', keysym='space' if char == ' ' else char)
+
+
+def send_command(command, payload=b'', port=None, timeout=2, **kwargs):
+    """
+    向本地的贴图或回放缓冲进程发送命令，命令头为一行json，之后是payload字节
+    port: 默认为贴图进程的端口
+    return: 对方返回的一行json，没有进程监听时为None
+    """
+    header = dict(kwargs, cmd=command, length=len(payload))
+    try:
+        with socket.create_connection(('127.0.0.1', port or Style.pin_port), timeout=timeout) as sock:
+            sock.sendall(json.dumps(header).encode() + b'\n')
+            sock.sendall(payload)
+            return json.loads(sock.makefile('rb').readline() or 'null')
+    except OSError:
+        return None
+
+
+def serve_commands(server, commands):
+    """
+    处理send_command发来的命令，直到server关闭
+    commands: 命令名 -> 处理函数(header, payload)，返回值以json回复
+    命令头限长4KB，payload长度超过Style.command_max_bytes或未知命令在读取payload前拒绝
+    单个连接出错(包括处理函数抛出的异常)只记录日志并断开该连接，不影响后续命令
+    """
+    while True:
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            return
+        with conn, conn.makefile('rb') as stream:     # 文件对象也要关闭，否则连接不会真正断开
+            try:
+                header = json.loads(stream.readline(4096))
+                if not isinstance(header, dict):
+                    raise ValueError(f'command header is not an object: {header!r}')
+                length = header['length']
+                if not isinstance(length, int) or not 0 <= length <= Style.command_max_bytes:
+                    raise ValueError(f'payload length {length!r} out of range')
+                handler = commands[header['cmd']]
+                payload = stream.read(length)
+                if len(payload) != length:
+                    raise ValueError(f'payload truncated: {len(payload)}/{length}')
+                conn.sendall(json.dumps(handler(header, payload)).encode() + b'\n')
+            except (OSError, ValueError, KeyError) as e:
+                logger.info('bad command: %s', e)
+            except Exception:
+                logger.exception('command failed')
 
 
 def set_clipboard_image(image_file):
@@ -1256,10 +3998,18 @@ def set_clipboard_image(image_file):
     复制图片到系统剪切板实现
     """
     if os.name == 'posix':
-        cmd = f"xclip -selection clipboard -target image/png {image_file}"
-        os.system(cmd)
+        if image_file.lower().endswith('.png'):
+            cmd = f"xclip -selection clipboard -target image/png {image_file}"
+            os.system(cmd)
+        else:   # 其它格式粘贴时不被普遍支持，转为PNG通过标准输入交给xclip
+            output = io.BytesIO()
+            Image.open(image_file).save(output, 'PNG', compress_level=1)
+            try:
+                subprocess.run(['xclip', '-selection', 'clipboard', '-target', 'image/png'],
+                               input=output.getvalue(), timeout=5)
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.info('clipboard: %s', e)
     else:
-        import io
         import win32clipboard
         image = Image.open(image_file)
         output = io.BytesIO()
@@ -1272,11 +4022,185 @@ def set_clipboard_image(image_file):
         win32clipboard.CloseClipboard()
 
 
+def quick_capture(box):
+    """
+    直接截取指定区域保存到历史和剪切板，不显示截图界面，也不截取全屏
+    box: 虚拟桌面坐标
+    """
+    st = time.perf_counter()
+    image = grab_screen(tuple(box))
+    grab_time = time.perf_counter() - st
+    img_file = ScreenHistory().add(image, box)
+    save_time = time.perf_counter() - st - grab_time
+    set_clipboard_image(img_file)
+    logger.info('quick capture %s: grab %.1f ms, save %.1f ms, total %.1f ms', list(box), grab_time * 1000,
+                save_time * 1000, (time.perf_counter() - st) * 1000)
+    return img_file
+
+
+def synthetic_screen(width, height):
+    """
+    基准测试使用的固定屏幕：窗口、标题栏和文字行组成的网格，区域检测和吸附有真实的工作量
+    """
+    image = Image.new('RGB', (width, height), (236, 236, 236))
+    draw = ImageDraw.Draw(image)
+    for i, x in enumerate(range(0, width, 320)):
+        for j, y in enumerate(range(0, height, 240)):
+            draw.rectangle((x + 10, y + 10, x + 300, y + 220), fill=(250, 250, 250), outline=(120, 120, 120))
+            draw.rectangle((x + 10, y + 10, x + 300, y + 36), fill=(40 + (i * 37 + j * 53) % 160, 90, 160))
+            for k in range(y + 50, y + 200, 18):
+                draw.line((x + 24, k, x + 24 + (k * 7 + x) % 260, k), fill=(40, 40, 40), width=3)
+    return image
+
+
+def benchmark_scenario(name, size):
+    """
+    在独立进程中回放一个场景，每个场景都从选框开始
+    return: 场景的耗时、事件数、回调耗时分布和进程内存峰值
+    """
+    import resource
+    folder = tempfile.mkdtemp()
+    os.chdir(folder)        # 设置和历史截图写入临时目录，使用默认设置保证结果可重复
+    Style.load_settings()
+    width, height = size
+    screen = synthetic_screen(width, height)
+    profiler = HandlerProfiler()
+    profiler.dumped = True  # 结果由基准测试汇总输出
+    st = time.perf_counter()
+    shot = ScreenShot(profiler, screen, grab=lambda box: screen.crop(tuple(map(int, box))))
+    shot.root.update()
+    startup = time.perf_counter() - st
+    replay = EventReplay(shot)
+    x1, y1, x2, y2 = width // 4, height // 4, width * 3 // 4, height * 3 // 4
+    st = time.perf_counter()
+    for i in range(60):     # 选框前鼠标扫过屏幕：辅助线、放大镜、悬停区域
+        replay.move(width * i // 60, height * i // 60)
+    replay.drag(x1, y1, x2, y2)
+    if name == 'adjust':
+        replay.drag(x2, y2, x2 + width // 8, y2 + height // 8)
+        replay.drag(width // 2, height // 2, width // 2 - width // 8, height // 2 - height // 8)
+    elif name == 'pen':
+        replay.tool(4)
+        for k in range(5):
+            replay.drag(x1 + 20, y1 + 20 + k * 30, x2 - 20, y2 - 20 - k * 30, steps=40)
+    elif name == 'text':
+        replay.tool(5)
+        replay.click(shot.canvas, x1 + 20, y1 + 20)
+        replay.type('The quick brown fox jumps over the lazy dog')
+    elif name == 'undo':
+        replay.tool(0)
+        for k in range(20):
+            replay.drag(x1 + 10 + k * 5, y1 + 10 + k * 5, x1 + 60 + k * 10, y1 + 60 + k * 10, steps=10)
+        for k in range(20):
+            replay.tool(8)
+    elif name == 'save':
+        replay.tool(3)
+        replay.drag(x1 + 20, y1 + 20, x2 - 20, y2 - 20)
+        try:
+            replay.tool(12)
+        except tk.TclError:     # 保存后界面已关闭
+            pass
+    elapsed = time.perf_counter() - st
+    handlers = {key: {k: item[k] for k in ('count', 'p50_ms', 'p95_ms', 'max_ms')}
+                for key, item in profiler.summary()['handlers'].items()}
+    if name != 'save':
+        shot.cancel_process_event()
+    shutil.rmtree(folder, ignore_errors=True)
+    return {
+        'scenario': name,
+        'resolution': f'{width}x{height}',
+        'startup_ms': startup * 1000,
+        'timings': shot.timings,
+        'wall_ms': elapsed * 1000,
+        'events': replay.count,
+        'handlers': handlers,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def run_benchmark(output, resolutions, scenarios=('select', 'adjust', 'pen', 'text', 'undo', 'save')):
+    """
+    截图界面的事件回放基准测试，需要图形界面，可在Xvfb中运行:
+        xvfb-run -s "-screen 0 3840x2160x24" python3 tk_capture.py --benchmark
+    每个场景在新进程中运行，内存峰值互不影响，结果输出为json
+    """
+    import multiprocessing
+    results = []
+    print(f"{'resolution':<12}{'scenario':<10}{'events':>7}{'startup':>10}{'wall ms':>10}"
+          f"{'worst p95':>10}{'rss MB':>8}")
+    for resolution in resolutions:
+        size = tuple(map(int, resolution.lower().split('x')))
+        for name in scenarios:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(benchmark_scenario, name, size).result()
+            results.append(result)
+            worst = max((item['p95_ms'] for item in result['handlers'].values()), default=0)
+            print(f"{resolution:<12}{name:<10}{result['events']:>7}{result['startup_ms']:>10.1f}"
+                  f"{result['wall_ms']:>10.1f}{worst:>10.2f}{result['max_rss_kb'] / 1024:>8.1f}")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'version': Style.version, 'results': results}, f, indent=2)
+
+
 def main():
+    parser = argparse.ArgumentParser(description='TkCapture')
+    parser.add_argument('--profile', nargs='?', const='profile.json', metavar='FILE',
+                        help='time every overlay event handler and write a JSON summary to FILE')
+    parser.add_argument('--profile-trace', metavar='FILE',
+                        help='also write a cProfile trace (pstats) of the session to FILE')
+    parser.add_argument('--batch', nargs='+', metavar=('MARKS', 'IMAGE'),
+                        help='headless: draw the marks in the MARKS json file onto every IMAGE')
+    parser.add_argument('--output', metavar='PATH', help='output directory of --batch, or file of --replay-dump')
+    parser.add_argument('--jobs', type=int, metavar='N', help='worker processes of --batch, default cpu count')
+    parser.add_argument('--benchmark', nargs='?', const='benchmark.json', metavar='FILE',
+                        help='replay scripted overlay sessions on a synthetic screen and write timings to FILE')
+    parser.add_argument('--resolutions', default='1280x720,1920x1080,2560x1440', metavar='WxH,...',
+                        help='screen resolutions of --benchmark')
+    parser.add_argument('--replay', metavar='X1,Y1,X2,Y2',
+                        help='keep recording the region into an in-memory ring buffer for instant replay')
+    parser.add_argument('--replay-dump', nargs='?', const=10, type=float, metavar='SECONDS',
+                        help='save the last SECONDS (default 10) of the running --replay buffer as GIF/WebP')
+    parser.add_argument('--last', action='store_true', help='capture the last selected region without the overlay')
+    parser.add_argument('--region', metavar='NAME', help='capture a region saved by --save-region without the overlay')
+    parser.add_argument('--save-region', metavar='NAME', help='save the last selected region under NAME')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    if args.batch:
+        batch_render(args.batch[0], args.batch[1:], args.output, args.jobs)
+        return
+    if args.benchmark:
+        run_benchmark(os.path.abspath(args.benchmark), args.resolutions.split(','))
+        return
+    profiler = None
+    if args.profile or args.profile_trace:
+        profiler = HandlerProfiler(args.profile and os.path.abspath(args.profile),
+                                   args.profile_trace and os.path.abspath(args.profile_trace))
+    output = args.output and os.path.abspath(args.output)
     if _dir := os.path.dirname(__file__):
         os.chdir(_dir)
     Style.load_settings()
-    shot = ScreenShot()
+    if args.replay_dump:
+        result = send_command('dump', port=Style.replay_port, timeout=120, seconds=args.replay_dump, file=output)
+        if result is None:
+            print('no replay buffer running')
+        else:
+            print(result['file'] or 'replay buffer is empty')
+        return
+    if args.save_region:
+        if not Style.last_region:
+            parser.error('no region selected yet')
+        Style.saved_regions[args.save_region] = Style.last_region
+        Style.write_settings(Style.dump_settings())
+        return
+    if args.last or args.region:
+        box = Style.last_region if args.last else Style.saved_regions.get(args.region)
+        if not box:
+            parser.error('no region selected yet' if args.last else f'unknown region: {args.region}')
+        quick_capture(box)
+        return
+    if args.replay:
+        ReplayBuffer(tuple(map(int, args.replay.split(',')))).serve()
+        return
+    shot = ScreenShot(profiler)
     shot.run()
 
 